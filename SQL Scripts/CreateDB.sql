@@ -1,23 +1,42 @@
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
 CREATE TABLE Users
 (
-    uid          SERIAL PRIMARY KEY,
-    username     varchar(30) UNIQUE  NOT NULL,
-    password     varchar(100)        NOT NULL,
-    created_on   TIMESTAMPTZ         NOT NULL DEFAULT CURRENT_TIMESTAMP,
-    email        varchar(100) UNIQUE NOT NULL,
-    first_name   varchar(30)         NOT NULL,
-    last_name    varchar(30)         NOT NULL,
-    phone_number varchar(10) UNIQUE  NOT NULL
+    uid              SERIAL PRIMARY KEY,
+    username         varchar(30) UNIQUE  NOT NULL,
+    password         varchar(100)        NOT NULL,
+    created_on       TIMESTAMPTZ         NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    email            varchar(100) UNIQUE NOT NULL,
+    first_name       varchar(30)         NOT NULL,
+    last_name        varchar(30)         NOT NULL,
+    phone_number     varchar(10) UNIQUE  NOT NULL,
+    contacts_version BIGINT              NOT NULL DEFAULT 0,
+    username_since   TIMESTAMPTZ         NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    search_text      TEXT GENERATED ALWAYS AS (lower(username || ' ' || first_name || ' ' ||
+                                                     last_name || ' ' || email)) STORED
 );
 
+CREATE INDEX users_search_text_trgm_idx ON Users USING GIN (search_text gin_trgm_ops);
+
 CREATE TABLE Chat_Group
 (
     cid        serial PRIMARY KEY,
     uid        INTEGER REFERENCES Users (uid) ON DELETE CASCADE,
     name       varchar(25) NOT NULL,
-    created_on TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+    created_on TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    version    BIGINT      NOT NULL DEFAULT 0
 );
 
+CREATE INDEX chat_group_uid_idx ON Chat_Group (uid);
+
+CREATE TABLE Deleted_Chat_Versions
+(
+    id    BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    total BIGINT NOT NULL DEFAULT 0
+);
+
+INSERT INTO Deleted_Chat_Versions DEFAULT VALUES;
+
 CREATE TABLE Chat_Members
 (
     cid       INTEGER REFERENCES Chat_Group (cid) ON DELETE CASCADE,
@@ -26,22 +45,39 @@ CREATE TABLE Chat_Members
     PRIMARY KEY (cid, uid)
 );
 
+CREATE INDEX chat_members_uid_idx ON Chat_Members (uid);
+
 CREATE TABLE Messages
 (
     mid        serial PRIMARY KEY,
     cid        INTEGER REFERENCES Chat_Group (cid) ON DELETE CASCADE,
     uid        INTEGER REFERENCES Users (uid) ON DELETE CASCADE,
     message    VARCHAR(500),
-    created_on TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+    created_on TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    likes      INTEGER     NOT NULL DEFAULT 0,
+    dislikes   INTEGER     NOT NULL DEFAULT 0,
+    updated_on TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    version    BIGINT      NOT NULL DEFAULT 0,
+    search     TSVECTOR GENERATED ALWAYS AS (to_tsvector('english', COALESCE(message, ''))) STORED
 );
 
+CREATE INDEX messages_cid_created_on_mid_idx ON Messages (cid, created_on DESC, mid DESC);
+CREATE INDEX messages_cid_version_mid_idx ON Messages (cid, version, mid);
+CREATE INDEX messages_search_idx ON Messages USING GIN (search);
+
 CREATE TABLE Photo
 (
-    pid   serial PRIMARY KEY,
-    image varchar(2083) NOT NULL,
-    mid   INTEGER REFERENCES Messages (mid) ON DELETE CASCADE
+    pid      serial PRIMARY KEY,
+    image    varchar(2083) NOT NULL,
+    mid      INTEGER REFERENCES Messages (mid) ON DELETE CASCADE,
+    status   VARCHAR(10)   NOT NULL DEFAULT 'ready'
+        CHECK (status IN ('pending', 'ready', 'failed')),
+    variants JSONB         NOT NULL DEFAULT '{}'
 );
 
+CREATE INDEX photo_mid_idx ON Photo (mid);
+CREATE INDEX photo_unfinished_idx ON Photo (mid) WHERE status <> 'ready';
+
 CREATE TABLE Replies
 (
     replied_to INTEGER REFERENCES Messages (mid) ON DELETE CASCADE,
@@ -76,3 +112,23 @@ CREATE TABLE Hashtags_Messages
     mid     INTEGER REFERENCES Messages (mid)
 );
 
+CREATE TABLE Activity_Rollup
+(
+    hour   TIMESTAMPTZ NOT NULL,
+    metric VARCHAR(20) NOT NULL,
+    mid    INTEGER     NOT NULL DEFAULT 0,
+    uid    INTEGER     NOT NULL DEFAULT 0,
+    total  INTEGER     NOT NULL DEFAULT 0,
+    PRIMARY KEY (metric, mid, uid, hour)
+);
+
+CREATE INDEX activity_rollup_metric_hour_idx ON Activity_Rollup (metric, hour);
+
+CREATE TABLE Trending_Snapshot
+(
+    worker      VARCHAR(100) NOT NULL,
+    window_name VARCHAR(10)  NOT NULL,
+    taken_on    TIMESTAMPTZ  NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    counts      JSONB        NOT NULL,
+    PRIMARY KEY (worker, window_name)
+);
@@ -7,4 +7,7 @@ DROP TABLE IF EXISTS "vote" CASCADE;
 DROP TABLE IF EXISTS "messages" CASCADE;
 DROP TABLE IF EXISTS "photo" CASCADE;
 DROP TABLE IF EXISTS "replies" CASCADE;
-DROP TABLE IF EXISTS "users" CASCADE;
\ No newline at end of file
+DROP TABLE IF EXISTS "users" CASCADE;
+DROP TABLE IF EXISTS "activity_rollup" CASCADE;
+DROP TABLE IF EXISTS "trending_snapshot" CASCADE;
+DROP TABLE IF EXISTS "deleted_chat_versions" CASCADE;
@@ -0,0 +1,3 @@
+-- Supports keyset pagination of chat history on (created_on, mid) within a chat
+CREATE INDEX CONCURRENTLY IF NOT EXISTS messages_cid_created_on_mid_idx
+    ON Messages (cid, created_on DESC, mid DESC);
@@ -0,0 +1,15 @@
+-- Denormalized like/dislike counters maintained by the vote write paths.
+-- Run `flask reconcile-votes` at any time to rebuild them from the vote table.
+ALTER TABLE Messages
+    ADD COLUMN IF NOT EXISTS likes    INTEGER NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS dislikes INTEGER NOT NULL DEFAULT 0;
+
+UPDATE Messages
+SET likes    = vote_count.likes,
+    dislikes = vote_count.dislikes
+FROM (SELECT mid,
+             COUNT(*) FILTER (WHERE upvote)     AS likes,
+             COUNT(*) FILTER (WHERE NOT upvote) AS dislikes
+      FROM Vote
+      GROUP BY mid) AS vote_count
+WHERE Messages.mid = vote_count.mid;
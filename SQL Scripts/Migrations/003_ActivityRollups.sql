@@ -0,0 +1,13 @@
+-- Daily activity counters read by the /stats endpoints. mid/uid are 0 for global counters.
+-- Run `flask backfill-rollups` after applying to populate them from history.
+CREATE TABLE IF NOT EXISTS Activity_Rollup
+(
+    day    DATE        NOT NULL,
+    metric VARCHAR(20) NOT NULL,
+    mid    INTEGER     NOT NULL DEFAULT 0,
+    uid    INTEGER     NOT NULL DEFAULT 0,
+    total  INTEGER     NOT NULL DEFAULT 0,
+    PRIMARY KEY (metric, mid, uid, day)
+);
+
+CREATE INDEX IF NOT EXISTS activity_rollup_metric_day_idx ON Activity_Rollup (metric, day);
@@ -0,0 +1,10 @@
+-- Decayed trending hashtag counts each worker shares with the others.
+-- Run `flask seed-trending` after applying to seed them from recent messages.
+CREATE TABLE IF NOT EXISTS Trending_Snapshot
+(
+    worker      VARCHAR(100) NOT NULL,
+    window_name VARCHAR(10)  NOT NULL,
+    taken_on    TIMESTAMPTZ  NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    counts      JSONB        NOT NULL,
+    PRIMARY KEY (worker, window_name)
+);
@@ -0,0 +1,9 @@
+-- Photos are committed as 'pending' while their image is uploaded in the background.
+-- While pending or failed, image holds the spooled filename instead of a url.
+-- Run `flask resume-uploads` to retry images still in the spool directory.
+ALTER TABLE Photo
+    ADD COLUMN IF NOT EXISTS status VARCHAR(10) NOT NULL DEFAULT 'ready'
+        CHECK (status IN ('pending', 'ready', 'failed'));
+
+CREATE INDEX IF NOT EXISTS photo_mid_idx ON Photo (mid);
+CREATE INDEX IF NOT EXISTS photo_unfinished_idx ON Photo (mid) WHERE status <> 'ready';
@@ -0,0 +1,3 @@
+-- Urls of resized copies of each photo, keyed by variant name (e.g. thumb, medium).
+ALTER TABLE Photo
+    ADD COLUMN IF NOT EXISTS variants JSONB NOT NULL DEFAULT '{}';
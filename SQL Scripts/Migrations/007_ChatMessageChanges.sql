@@ -0,0 +1,11 @@
+-- Messages record when their votes, replies or photo last changed so clients can sync
+-- only what changed, and chats count every change to their messages for use as an ETag.
+ALTER TABLE Messages
+    ADD COLUMN IF NOT EXISTS updated_on TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP;
+
+UPDATE Messages SET updated_on = created_on;
+
+CREATE INDEX IF NOT EXISTS messages_cid_updated_on_mid_idx ON Messages (cid, updated_on, mid);
+
+ALTER TABLE Chat_Group
+    ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0;
@@ -0,0 +1,3 @@
+-- Counts every change to a user's contacts so contact lists can be revalidated cheaply.
+ALTER TABLE Users
+    ADD COLUMN IF NOT EXISTS contacts_version BIGINT NOT NULL DEFAULT 0;
@@ -0,0 +1,6 @@
+-- Messages keep a generated tsvector of their text, GIN indexed, for full-text search.
+ALTER TABLE Messages
+    ADD COLUMN IF NOT EXISTS search TSVECTOR
+        GENERATED ALWAYS AS (to_tsvector('english', COALESCE(message, ''))) STORED;
+
+CREATE INDEX IF NOT EXISTS messages_search_idx ON Messages USING GIN (search);
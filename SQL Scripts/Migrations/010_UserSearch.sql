@@ -0,0 +1,10 @@
+-- Users keep a lowercased text of their username, names and email, trigram indexed so
+-- type-ahead searches match prefixes, substrings and misspellings without scanning users.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+ALTER TABLE Users
+    ADD COLUMN IF NOT EXISTS search_text TEXT
+        GENERATED ALWAYS AS (lower(username || ' ' || first_name || ' ' || last_name || ' ' ||
+                                   email)) STORED;
+
+CREATE INDEX IF NOT EXISTS users_search_text_trgm_idx ON Users USING GIN (search_text gin_trgm_ops);
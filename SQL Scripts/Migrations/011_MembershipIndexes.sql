@@ -0,0 +1,3 @@
+-- Chats of a user are looked up by the uid of their members and owner.
+CREATE INDEX IF NOT EXISTS chat_members_uid_idx ON Chat_Members (uid);
+CREATE INDEX IF NOT EXISTS chat_group_uid_idx ON Chat_Group (uid);
@@ -0,0 +1,9 @@
+-- Messages are stamped with the chat version of their last change. Writers increment the
+-- chat version first, which locks the chat until commit, so versions follow commit order
+-- and clients can sync changes by version without missing late commits.
+ALTER TABLE Messages
+    ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0;
+
+CREATE INDEX IF NOT EXISTS messages_cid_version_mid_idx ON Messages (cid, version, mid);
+
+DROP INDEX IF EXISTS messages_cid_updated_on_mid_idx;
@@ -0,0 +1,9 @@
+-- Keeps the versions of deleted chats, plus one per deletion, so the sum of all chat
+-- versions and this total increases with every change to any message, deletions included.
+CREATE TABLE IF NOT EXISTS Deleted_Chat_Versions
+(
+    id    BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    total BIGINT NOT NULL DEFAULT 0
+);
+
+INSERT INTO Deleted_Chat_Versions DEFAULT VALUES ON CONFLICT DO NOTHING;
@@ -0,0 +1,8 @@
+-- Records since when each user holds their username, so tokens naming a user can only
+-- resolve to whoever held the name when they were issued. Existing users held theirs all
+-- along.
+ALTER TABLE Users
+    ADD COLUMN IF NOT EXISTS username_since TIMESTAMPTZ NOT NULL DEFAULT '-infinity';
+
+ALTER TABLE Users
+    ALTER COLUMN username_since SET DEFAULT CURRENT_TIMESTAMP;
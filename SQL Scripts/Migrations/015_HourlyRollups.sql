@@ -0,0 +1,10 @@
+-- Activity rollups are kept per hour so hourly /stats series are read from them too, and
+-- days and weeks add their hours up. Existing daily counts stay at the first hour of their
+-- day. Run `flask backfill-rollups` after applying to spread them over their hours.
+ALTER TABLE Activity_Rollup
+    RENAME COLUMN day TO hour;
+
+ALTER TABLE Activity_Rollup
+    ALTER COLUMN hour TYPE TIMESTAMPTZ USING hour::timestamptz;
+
+ALTER INDEX IF EXISTS activity_rollup_metric_day_idx RENAME TO activity_rollup_metric_hour_idx;
@@ -1,17 +1,27 @@
 import os
 
 import cloudinary
-from flask import Flask
+from flask import Flask, jsonify, request
 from flask_cors import CORS
 from flask_jwt_extended import JWTManager
 from flask_restful import Api
 
+from dao.dao import commit_unit_of_work, close_unit_of_work
+from dao.message_dao import MessageDAO
+from dao.stats_dao import StatsDAO
+from dao.trending_dao import TrendingDAO
 from handlers.message import MessageHandler
-from handlers.users import UserHandler
+from handlers.stats import StatsHandler
 from resources import UserRegistration, TokenRefresh, UserLogin, Chats, \
-    Index, ChatMessages, Contacts, Users, Chat, \
+    Index, ChatEvents, ChatMessages, Contacts, Users, Chat, \
     LikeChatMessage, DislikeChatMessage, ReplyChatMessage, \
-    User, Contact, Messages, Message, ChatMembers
+    User, Contact, Messages, Message, ChatMembers, SearchMessages, \
+    UserSearch
+from utils.cache import cached_response, get_stats_cache
+from utils.compression import compress_response
+from utils.serialization import init_json, output_json
+from utils.trending import seed_from_history
+from utils.uploads import get_uploader, send_image
 
 APP = Flask(__name__)
 CONFIG = f'config.config.{os.getenv("FLASK_SETTINGS")}'
@@ -19,6 +29,12 @@ APP.config.from_object(CONFIG)
 CORS = CORS(APP, resources={r"*": {"origins": "*"}})
 API = Api(APP, prefix='/api')
 jwt = JWTManager(APP)
+init_json(APP)
+API.representations['application/json'] = output_json
+# after_request hooks run in reverse, so the unit of work commits before compression
+APP.after_request(compress_response)
+APP.after_request(commit_unit_of_work)
+APP.teardown_appcontext(close_unit_of_work)
 
 if APP.config['ENV'] == 'production':
     cloudinary.config(cloud_name=APP.config['CLOUD_NAME'], api_key=APP.config['API_KEY'],
@@ -26,106 +42,188 @@ if APP.config['ENV'] == 'production':
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 
 
+# ------------------------images-------------------------------
+
+@APP.route('/images/<string:name>')
+def image(name):
+    """
+    Gets image from the local image store
+    :param name: str
+    :return: image
+    """
+    return send_image(name)
+
+
 # ------------------------statistics-------------------------------
 
 @APP.route('/stats/trending')
+@cached_response(ttl=15, tags=('hashtags',))
 def trending_topics():
     """
-    Gets trending hashtags from database
+    Gets trending hashtags over the requested window
     :return: JSON
     """
-    return MessageHandler().get_trending_hashtags(), 200
+    return MessageHandler().get_trending_hashtags(request.args)
 
 
 @APP.route('/stats/messages')
+@cached_response(ttl=60, tags=('messages',))
 def num_of_posts():
     """
-    Gets number of messages posted per day from database
+    Gets number of messages posted per bucket from database
     :return: JSON
     """
-    return MessageHandler().get_num_messages_daily(), 200
+    return StatsHandler().get_metric('messages', request.args)
 
 
 @APP.route('/stats/likes')
+@cached_response(ttl=60, tags=('votes',))
 def num_of_likes():
     """
-    Gets number of likes per day from database
+    Gets number of likes per bucket from database
     :return: JSON
     """
-    return MessageHandler().get_num_likes_daily(), 200
+    return StatsHandler().get_metric('likes', request.args)
 
 
 @APP.route('/stats/replies')
+@cached_response(ttl=60, tags=('replies',))
 def num_of_replies():
     """
-    Gets number of replies per day from database
+    Gets number of replies per bucket from database
     :return: JSON
     """
-    return MessageHandler().get_num_replies_daily(), 200
+    return StatsHandler().get_metric('replies', request.args)
 
 
 @APP.route('/stats/dislikes')
+@cached_response(ttl=60, tags=('votes',))
 def num_of_dislikes():
     """
-    Gets number of dislikes per day from database
+    Gets number of dislikes per bucket from database
     :return: JSON
     """
-    return MessageHandler().get_num_dislikes_daily(), 200
+    return StatsHandler().get_metric('dislikes', request.args)
 
 
 @APP.route('/stats/active')
+@cached_response(ttl=300, tags=('messages',))
 def active_users():
     """
-    Gets daily active users from database
+    Gets most active users per bucket from database
     :return: JSON
     """
-    return UserHandler().get_daily_active_users(), 200
+    return StatsHandler().get_active_users(request.args)
 
 
 @APP.route('/stats/users/<int:uid>/messages')
+@cached_response(ttl=120, tags=('messages',))
 def num_of_mess_per_day(uid):
     """
-    Gets numbers of posted messages by user per day
+    Gets numbers of posted messages by user per bucket
     :param uid: int
     :return: JSON
     """
-    return UserHandler().get_num_messages_user(uid)
+    return StatsHandler().get_user_messages(uid, request.args)
 
 
 @APP.route('/stats/photos/<int:pid>/replies')
+@cached_response(ttl=60, tags=('replies',))
 def num_of_replies_photo(pid):
     """
-    Gets number of photo replies per day for the given photo id
+    Gets number of photo replies per bucket for the given photo id
     :param pid: int
     :return: JSON
     """
-    return MessageHandler().get_num_replies_photo(pid)
+    return StatsHandler().get_metric('replies', request.args, key=pid)
 
 
 @APP.route('/stats/photos/<int:pid>/likes')
+@cached_response(ttl=60, tags=('votes',))
 def num_of_likes_photos(pid):
     """
-    Gets number of likes for the given photo id
+    Gets number of likes per bucket for the given photo id
     :param pid: int
     :return: JSON
     """
-    return MessageHandler().get_num_likes_photo(pid)
+    return StatsHandler().get_metric('likes', request.args, key=pid)
 
 
 @APP.route('/stats/photos/<int:pid>/dislikes')
+@cached_response(ttl=60, tags=('votes',))
 def num_of_dislikes_photos(pid):
     """
-    Gets number of dislikes for the given photo id
+    Gets number of dislikes per bucket for the given photo id
     :param pid: int
     :return: JSON
     """
-    return MessageHandler().get_num_dislikes_photo(pid)
+    return StatsHandler().get_metric('dislikes', request.args, key=pid)
+
+
+@APP.route('/stats/cache')
+def stats_cache():
+    """
+    Gets size and hit/miss counters of the stats response cache
+    :return: JSON
+    """
+    return jsonify(get_stats_cache().stats())
+
+
+# ------------------------commands-------------------------------
+
+@APP.cli.command('reconcile-votes')
+def reconcile_votes():
+    """
+    Rebuilds message like/dislike counters from the vote table
+    """
+    dao = MessageDAO()
+    corrected = dao.reconcile_vote_counts()
+    dao.commit()
+    print(f'Reconciled vote counters of {corrected} messages')
+
+
+@APP.cli.command('backfill-rollups')
+def backfill_rollups():
+    """
+    Rebuilds hourly activity rollups from message, reply and vote history
+    """
+    dao = StatsDAO()
+    written = dao.rebuild_rollups()
+    dao.commit()
+    print(f'Wrote {written} activity rollup rows')
+
+
+@APP.cli.command('seed-trending')
+def seed_trending():
+    """
+    Seeds trending hashtags from the hashtags of recent messages
+    """
+    config = APP.config['TRENDING']
+    dao = TrendingDAO()
+    seeded = seed_from_history(dao, config['WINDOWS'], config['CAPACITY'])
+    dao.commit()
+    print(f'Seeded trending hashtags from {seeded} hourly hashtag counts')
+
+
+@APP.cli.command('resume-uploads')
+def resume_uploads():
+    """
+    Uploads images still spooled from pending or failed uploads, e.g. after a restart
+    """
+    uploader = get_uploader()
+    photos = [photo for photo in MessageDAO().get_unfinished_photos()
+              if os.path.exists(os.path.join(uploader.spool_dir, photo['image']))]
+    for photo in photos:
+        uploader.submit(photo['mid'], photo['image'])
+    uploader.shutdown()
+    print(f'Resumed upload of {len(photos)} images')
 
 
 API.add_resource(Index, '/')
 API.add_resource(UserRegistration, '/register')
 API.add_resource(UserLogin, '/login')
 API.add_resource(Users, '/users')
+API.add_resource(UserSearch, '/users/search')
 API.add_resource(User, '/users/<string:user>')
 API.add_resource(Chats, '/chats')
 API.add_resource(Chat, '/chats/<int:cid>')
@@ -133,7 +231,9 @@ API.add_resource(ChatMembers, '/chats/<int:cid>/members')
 API.add_resource(Contacts, '/contacts')
 API.add_resource(Contact, '/contacts/<int:uid>')
 API.add_resource(ChatMessages, '/chats/<int:chat_id>/messages')
+API.add_resource(ChatEvents, '/chats/<int:chat_id>/events')
 API.add_resource(Messages, '/messages')
+API.add_resource(SearchMessages, '/messages/search')
 API.add_resource(Message, '/messages/<int:mid>')
 API.add_resource(LikeChatMessage, '/messages/<int:mid>/like')
 API.add_resource(DislikeChatMessage, '/messages/<int:mid>/dislike')
@@ -0,0 +1,81 @@
+"""
+Benchmarks JSON providers and response compression on get_all_messages sized payloads.
+Run from the repository root: python -m benchmarks.serialization [number of messages]
+"""
+import datetime
+import gzip
+import sys
+import timeit
+
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+from psycopg2.extras import RealDictRow
+
+from utils.compression import brotli
+from utils.serialization import OrjsonProvider, orjson
+
+REPEAT = 5
+
+
+def make_messages(count):
+    """
+    Makes rows shaped like the result of MessageDAO.get_all_messages
+    :param count: int
+    :return: list of RealDictRow
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    messages = []
+    for mid in range(count, 0, -1):
+        row = RealDictRow()
+        row.update({
+            'mid': mid, 'uid': mid % 50, 'cid': mid % 10,
+            'message': f'Message number {mid} about #topic{mid % 20} with some more words',
+            'image': f'images/{mid:064x}.jpg' if mid % 5 == 0 else None,
+            'image_variants': {'thumb': f'images/{mid:063x}t.jpg'} if mid % 5 == 0 else None,
+            'image_status': 'ready' if mid % 5 == 0 else None,
+            'likes': mid % 13, 'dislikes': mid % 7, 'username': f'user{mid % 50}',
+            'replies': list(range(mid + 1, min(mid + 4, count))),
+            'created_on': now - datetime.timedelta(minutes=mid),
+        })
+        messages.append(row)
+    return messages
+
+
+def best_of(function):
+    """
+    Times function, keeping the fastest of several runs
+    :param function: callable
+    :return: float milliseconds
+    """
+    return min(timeit.repeat(function, number=1, repeat=REPEAT)) * 1000
+
+
+def main(count):
+    """
+    Prints serialization and compression timings and sizes
+    :param count: int number of messages
+    """
+    app = Flask(__name__)
+    payload = {'messages': make_messages(count)}
+    providers = {'default': DefaultJSONProvider(app)}
+    if orjson is not None:
+        providers['orjson'] = OrjsonProvider(app)
+
+    print(f'{count} messages')
+    body = b''
+    with app.app_context():
+        for name, provider in providers.items():
+            elapsed = best_of(lambda provider=provider: provider.response(payload).get_data())
+            body = provider.response(payload).get_data()
+            print(f'  serialize {name:>8}: {elapsed:8.2f} ms  {len(body):>10} bytes')
+
+    codings = {'gzip': lambda: gzip.compress(body, compresslevel=6)}
+    if brotli is not None:
+        codings['br'] = lambda: brotli.compress(body, quality=5)
+    for name, compress in codings.items():
+        elapsed = best_of(compress)
+        print(f'  compress  {name:>8}: {elapsed:8.2f} ms  {len(compress()):>10} bytes')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
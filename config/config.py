@@ -1,10 +1,67 @@
 import os
+import tempfile
 from urllib.parse import urlparse
 
 
 class BaseConfig:
     SECRET_KEY = os.getenv('SECRET_KEY', 'bork_bork')
     JWT_SECRET_KEY = os.getenv('JWT_SECRET_KEY', 'bork_bops')
+    # Name of the identity claim used by flask-jwt-extended 3, so tokens it issued stay valid
+    JWT_IDENTITY_CLAIM = 'identity'
+    USE_X_SENDFILE = os.getenv('USE_X_SENDFILE', 'false').lower() == 'true'
+    JSON_PROVIDER = os.getenv('JSON_PROVIDER', 'orjson')
+    COMPRESSION = {
+        'MIN_SIZE': int(os.getenv('COMPRESSION_MIN_SIZE', 1024)),
+        'GZIP_LEVEL': int(os.getenv('COMPRESSION_GZIP_LEVEL', 6)),
+        'BROTLI_QUALITY': int(os.getenv('COMPRESSION_BROTLI_QUALITY', 5))
+    }
+    # One connection per request thread of a worker, see the Procfile
+    DATABASE_POOL = {
+        'MIN_SIZE': int(os.getenv('DATABASE_POOL_MIN_SIZE', 1)),
+        'MAX_SIZE': int(os.getenv('DATABASE_POOL_MAX_SIZE', 32)),
+        'TIMEOUT': float(os.getenv('DATABASE_POOL_TIMEOUT', 5)),
+        'PRE_PING': os.getenv('DATABASE_POOL_PRE_PING', 'true').lower() == 'true'
+    }
+    TRENDING = {
+        'WINDOWS': {'1h': 60 * 60, '24h': 24 * 60 * 60, '7d': 7 * 24 * 60 * 60},
+        'DEFAULT_WINDOW': '24h',
+        'CAPACITY': int(os.getenv('TRENDING_CAPACITY', 200)),
+        'SYNC_INTERVAL': float(os.getenv('TRENDING_SYNC_INTERVAL', 30))
+    }
+    STATS_CACHE = {
+        'MAX_SIZE': int(os.getenv('STATS_CACHE_MAX_SIZE', 512))
+    }
+    IDENTITY_CACHE = {
+        'MAX_SIZE': int(os.getenv('IDENTITY_CACHE_MAX_SIZE', 10000)),
+        'TTL': float(os.getenv('IDENTITY_CACHE_TTL', 300))
+    }
+    MEMBERSHIP_CACHE = {
+        'MAX_SIZE': int(os.getenv('MEMBERSHIP_CACHE_MAX_SIZE', 10000)),
+        'TTL': float(os.getenv('MEMBERSHIP_CACHE_TTL', 30))
+    }
+    BCRYPT = {
+        'ROUNDS': int(os.getenv('BCRYPT_ROUNDS', 12)),
+        'WORKERS': int(os.getenv('BCRYPT_WORKERS', 2)),
+        'MAX_PENDING': int(os.getenv('BCRYPT_MAX_PENDING', 8)),
+        'TIMEOUT': float(os.getenv('BCRYPT_TIMEOUT', 10))
+    }
+    EVENTS = {
+        'QUEUE_SIZE': int(os.getenv('EVENTS_QUEUE_SIZE', 100)),
+        'HEARTBEAT': float(os.getenv('EVENTS_HEARTBEAT', 15)),
+        # Streams each hold a request thread, so keep well below the threads per worker
+        'MAX_STREAMS': int(os.getenv('EVENTS_MAX_STREAMS', 16))
+    }
+    IMAGE_STORE = {
+        'BACKEND': os.getenv('IMAGE_STORE_BACKEND', 'local'),
+        'DIRECTORY': os.getenv('IMAGE_STORE_DIR'),
+        'SPOOL_DIR': os.getenv('IMAGE_SPOOL_DIR',
+                               os.path.join(tempfile.gettempdir(), 'bork-spool')),
+        'WORKERS': int(os.getenv('IMAGE_UPLOAD_WORKERS', 2)),
+        'MAX_ATTEMPTS': int(os.getenv('IMAGE_UPLOAD_MAX_ATTEMPTS', 5)),
+        'RETRY_DELAY': float(os.getenv('IMAGE_UPLOAD_RETRY_DELAY', 1)),
+        'VARIANTS': {'thumb': 160, 'medium': 640},
+        'VARIANT_QUALITY': int(os.getenv('IMAGE_VARIANT_QUALITY', 80))
+    }
 
 
 class DevelopmentConfig(BaseConfig):
@@ -32,5 +89,7 @@ class ProductionConfig(BaseConfig):
     CLOUD_NAME = os.getenv('CLOUDINARY_CLOUD_NAME')
     API_KEY = os.getenv('CLOUDINARY_API_KEY')
     API_SECRET = os.getenv('CLOUDINARY_API_SECRET')
+    IMAGE_STORE = {**BaseConfig.IMAGE_STORE,
+                   'BACKEND': os.getenv('IMAGE_STORE_BACKEND', 'cloudinary')}
     DEBUG = False
     ENV = 'production'
@@ -1,34 +1,83 @@
 from dao.dao import DAO
+from dao.message_dao import MessageDAO
+
+# Removed members listed in membership notifications, beyond which all streams of the chat
+# end since NOTIFY payloads are limited to 8000 bytes
+MAX_LISTED_MEMBERS = 500
 
 
 class ChatDAO(DAO):
 
-    def get_chat_messages(self, cid):
+    def get_chat_messages(self, cid, before=None, after=None, since=None, limit=50):
         """
-        Gets all messages belonging to specified chat with given id
+        Gets a page of messages belonging to specified chat with given id, newest first.
+        Pages are delimited by (created_on, mid) keyset cursors and one extra row is fetched
+        so callers can tell whether more messages exist. With since, messages created or
+        changed after it are returned instead, in the order their changes committed.
         :param cid: int
+        :param before: tuple (created_on, mid) to get messages older than
+        :param after: tuple (created_on, mid) to get messages newer than
+        :param since: tuple (chat version, mid) to get messages changed after, mid None to get
+        every message changed after the chat version
+        :param limit: int
         :return: RealDictCursor
         """
         cursor = self.get_cursor()
-        query = "WITH replies_query AS (SELECT reply, message AS replies_list " \
-                "FROM replies INNER JOIN messages ON replies.replied_to =  messages.mid " \
-                "GROUP BY reply, message), like_count AS (SELECT mid, COUNT(*) AS likes " \
-                "FROM vote WHERE upvote = TRUE GROUP BY mid), " \
-                "dislike_count AS (SELECT mid, COUNT(*) AS dislikes " \
-                "FROM vote WHERE upvote = FALSE GROUP BY mid) " \
-                "SELECT messages.mid, users.uid, cid, message, image, " \
-                "COALESCE(likes, 0) AS likes, COALESCE(dislikes, 0) AS dislikes, " \
-                "username, COALESCE(replies_list, NULL) AS replies, messages.created_on " \
-                "FROM messages LEFT OUTER JOIN like_count ON messages.mid = like_count.mid " \
-                "LEFT OUTER JOIN dislike_count ON messages.mid = dislike_count.mid " \
-                "LEFT OUTER JOIN photo ON messages.mid = photo.mid " \
-                "INNER JOIN users ON messages.uid = users.uid " \
-                "LEFT OUTER JOIN replies_query ON messages.mid = replies_query.reply " \
-                "WHERE messages.cid = %s " \
-                "ORDER BY messages.created_on DESC"
+        column = 'created_on'
+        if since is not None:
+            column = 'version'
+            order = 'ASC'
+            version, mid = since
+            if mid is None:
+                keyset = 'AND messages.version > %s '
+                params = (cid, version, limit + 1)
+            else:
+                keyset = 'AND (messages.version, messages.mid) > (%s, %s) '
+                params = (cid, version, mid, limit + 1)
+        elif after:
+            keyset = 'AND (messages.created_on, messages.mid) > (%s, %s) '
+            order = 'ASC'
+            params = (cid, *after, limit + 1)
+        elif before:
+            keyset = 'AND (messages.created_on, messages.mid) < (%s, %s) '
+            order = 'DESC'
+            params = (cid, *before, limit + 1)
+        else:
+            keyset = ''
+            order = 'DESC'
+            params = (cid, limit + 1)
+        query = 'SELECT messages.mid, users.uid, cid, message, messages.likes, ' \
+                'messages.dislikes, username, messages.created_on, messages.updated_on, ' \
+                'messages.version FROM messages INNER JOIN users ON messages.uid = users.uid ' \
+                f'WHERE messages.cid = %s {keyset}' \
+                f'ORDER BY messages.{column} {order}, messages.mid {order} LIMIT %s'
+        cursor.execute(query, params)
+        return MessageDAO().load_relations(cursor.fetchall())
+
+    def get_chat_version(self, cid):
+        """
+        Gets version of chat, which is incremented whenever its messages or members change
+        :param cid: int
+        :return: int, None if chat does not exist
+        """
+        cursor = self.get_cursor()
+        query = 'SELECT version FROM chat_group WHERE cid = %s'
         cursor.execute(query, (cid,))
-        messages = cursor.fetchall()
-        return messages
+        chat = cursor.fetchone()
+        return chat['version'] if chat else None
+
+    def get_chats_version(self):
+        """
+        Gets a stamp that increases whenever a message of any chat changes or a chat is
+        deleted: the sum of the versions of all chats, which only increase, plus the versions
+        deleted chats had, counting each deletion once more
+        :return: int
+        """
+        cursor = self.get_cursor()
+        query = 'SELECT COALESCE(SUM(version), 0) ' \
+                '+ (SELECT total FROM deleted_chat_versions) AS stamp FROM chat_group'
+        cursor.execute(query)
+        return int(cursor.fetchone()['stamp'])
 
     def get_all_chats(self):
         """
@@ -61,14 +110,27 @@ class ChatDAO(DAO):
         :return: RealDictCursor
         """
         cursor = self.get_cursor()
-        query = 'WITH ChatMembers as (SELECT cid, uid FROM chat_members ' \
-                'UNION SELECT cid, uid FROM chat_group)' \
-                'SELECT uid, username ' \
-                'FROM  ChatMembers NATURAL INNER JOIN users ' \
-                'WHERE cid = %s'
-        cursor.execute(query, (cid,))
+        query = 'SELECT uid, username FROM users ' \
+                'WHERE uid IN (SELECT uid FROM chat_members WHERE cid = %s ' \
+                'UNION SELECT uid FROM chat_group WHERE cid = %s)'
+        cursor.execute(query, (cid, cid))
         return cursor.fetchall()
 
+    def get_chat_membership(self, cid):
+        """
+        Gets owner and members of specified chat
+        :param cid: int
+        :return: RealDictRow with owner uid and list of member uids, None if chat does not exist
+        """
+        cursor = self.get_cursor()
+        query = 'SELECT chat_group.uid AS owner, COALESCE(array_agg(chat_members.uid) ' \
+                "FILTER (WHERE chat_members.uid IS NOT NULL), '{}') AS members " \
+                'FROM chat_group LEFT OUTER JOIN chat_members ' \
+                'ON chat_members.cid = chat_group.cid ' \
+                'WHERE chat_group.cid = %s GROUP BY chat_group.uid'
+        cursor.execute(query, (cid,))
+        return cursor.fetchone()
+
     def get_owner_of_chat(self, cid):
         """
         Gets owner of chat from database
@@ -85,34 +147,43 @@ class ChatDAO(DAO):
 
     def insert_chat_group(self, chat_name, owner_id, members=None):
         """
-        Inserts a new chat group to the DB
+        Inserts a new chat group and all of its members to the DB in a single statement
         :param chat_name: str
         :param owner_id: int
         :param members: list containing uids of users to add
         :return: int
         """
         cursor = self.get_cursor()
-        query = 'INSERT INTO chat_group (name, uid) VALUES (%s, %s) RETURNING cid, created_on'
-        cursor.execute(query, (chat_name, owner_id))
-        results = cursor.fetchall()
-        cid = results[0]['cid']
-        created_on = results[0]['created_on']
-        self.commit()
-        if members:
-            for member in members:
-                self.insert_member(cid, member)
-        return cid, created_on
-
-    def insert_member(self, cid, member_to_add):
-        """
-        Inserts a new chat_member on the DB
+        query = 'WITH new_chat AS (INSERT INTO chat_group (name, uid) VALUES (%s, %s) ' \
+                'RETURNING cid, created_on), ' \
+                'new_members AS (INSERT INTO chat_members (cid, uid) ' \
+                'SELECT cid, member FROM new_chat, unnest(%s::int[]) AS member ' \
+                'ON CONFLICT DO NOTHING) ' \
+                'SELECT cid, created_on FROM new_chat'
+        cursor.execute(query, (chat_name, owner_id, list(members or [])))
+        result = cursor.fetchone()
+        return result['cid'], result['created_on']
+
+    def insert_members(self, cid, members_to_add):
+        """
+        Inserts new chat_members on the DB, skipping users who already are members. If any was
+        added, the chat version is incremented and workers are notified on commit.
         :param cid: int
-        :param member_to_add: int
+        :param members_to_add: list of uids
+        :return: int number of members added
         """
         cursor = self.get_cursor()
-        query = "insert into chat_members (cid, uid) values (%s, %s)"
-        cursor.execute(query, (cid, member_to_add,))
-        self.commit()
+        query = 'WITH added AS (INSERT INTO chat_members (cid, uid) ' \
+                'SELECT %(cid)s, unnest(%(uids)s::int[]) ' \
+                'ON CONFLICT DO NOTHING RETURNING uid), ' \
+                'chat_version AS (UPDATE chat_group SET version = version + 1 ' \
+                'WHERE cid = %(cid)s AND EXISTS (SELECT 1 FROM added)) ' \
+                'SELECT COUNT(*) AS num, CASE WHEN COUNT(*) > 0 THEN ' \
+                "pg_notify('chat_members', json_build_object('type', 'members', " \
+                "'cid', %(cid)s::int, 'removed', '[]'::json)::text) END AS notified " \
+                'FROM added'
+        cursor.execute(query, {'cid': cid, 'uids': list(members_to_add)})
+        return cursor.fetchone()['num']
 
     def get_user_chats(self, uid):
         """
@@ -121,31 +192,44 @@ class ChatDAO(DAO):
         :return: RealDictCursor
         """
         cursor = self.get_cursor()
-        query = 'WITH MyChats AS (SELECT cid, uid FROM chat_members WHERE uid = %s ' \
-                'UNION ' \
-                'SELECT cid, uid FROM chat_group WHERE uid = %s)' \
-                'SELECT chat_group.cid, chat_group.uid, chat_group.name, chat_group.created_on ' \
-                'FROM chat_group INNER JOIN MyChats ON chat_group.cid = MyChats.cid'
+        query = 'SELECT cid, uid, name, created_on FROM chat_group ' \
+                'WHERE uid = %s OR cid IN (SELECT cid FROM chat_members WHERE uid = %s)'
         cursor.execute(query, (uid, uid))
         return cursor.fetchall()
 
-    def remove_member(self, cid, member_to_remove):
+    def remove_members(self, cid, members_to_remove):
         """
-        Removes chat member from specified chat
+        Removes chat members from specified chat. If any was removed, the chat version is
+        incremented and workers are notified on commit, ending event streams of the removed.
         :param cid: int
-        :param member_to_remove: int
+        :param members_to_remove: list of uids
+        :return: int number of members removed
         """
         cursor = self.get_cursor()
-        query = 'DELETE FROM chat_members WHERE cid = %s AND uid = %s'
-        cursor.execute(query, (cid, member_to_remove))
-        self.commit()
+        query = 'WITH removed AS (DELETE FROM chat_members ' \
+                'WHERE cid = %(cid)s AND uid = ANY(%(uids)s) RETURNING uid), ' \
+                'chat_version AS (UPDATE chat_group SET version = version + 1 ' \
+                'WHERE cid = %(cid)s AND EXISTS (SELECT 1 FROM removed)) ' \
+                'SELECT COUNT(*) AS num, CASE WHEN COUNT(*) > 0 THEN ' \
+                "pg_notify('chat_members', json_build_object('type', 'members', " \
+                "'cid', %(cid)s::int, 'removed', CASE WHEN COUNT(*) <= %(max_listed)s " \
+                'THEN json_agg(uid) END)::text) END AS notified FROM removed'
+        cursor.execute(query, {'cid': cid, 'uids': list(members_to_remove),
+                               'max_listed': MAX_LISTED_MEMBERS})
+        return cursor.fetchone()['num']
 
     def delete_chat(self, cid):
         """
-        Deletes chat from database
+        Deletes chat from database, keeping its version in the total of deleted chats and
+        notifying workers on commit
         :param cid: int
         """
         cursor = self.get_cursor()
-        query = 'DELETE FROM chat_group WHERE cid = %s'
-        cursor.execute(query, (cid,))
-        self.commit()
+        query = 'WITH deleted AS (DELETE FROM chat_group WHERE cid = %(cid)s ' \
+                'RETURNING cid, version), ' \
+                'tombstone AS (UPDATE deleted_chat_versions ' \
+                'SET total = total + (SELECT SUM(version + 1) FROM deleted) ' \
+                'WHERE EXISTS (SELECT 1 FROM deleted)) ' \
+                "SELECT pg_notify('chat_members', json_build_object('type', 'deleted', " \
+                "'cid', cid)::text) FROM deleted"
+        cursor.execute(query, {'cid': cid})
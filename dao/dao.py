@@ -1,15 +1,130 @@
+from contextlib import contextmanager
+
 import psycopg2
 import psycopg2.extras
-from flask import current_app as app
+from flask import current_app as app, g
+
+from dao.pool import get_pool
+
+
+class UnitOfWork:
+
+    def __init__(self, pool):
+        """
+        Single connection and transaction shared by every DAO during an app context
+        :param pool: ConnectionPool
+        """
+        self._pool = pool
+        self._conn = None
+        self._depth = 0
+        self._after_commit = []
+        self._after_rollback = []
+
+    @property
+    def connection(self):
+        """
+        Gets the connection of the unit of work, checking one out of the pool on first use
+        :return: connection
+        """
+        if self._conn is None:
+            self._conn = self._pool.getconn()
+        return self._conn
+
+    def commit(self):
+        """
+        Commits the pending transaction and runs callbacks waiting for it
+        """
+        if self._conn is not None:
+            self._conn.commit()
+        self._after_rollback = []
+        callbacks, self._after_commit = self._after_commit, []
+        for callback in callbacks:
+            callback()
+
+    def rollback(self):
+        """
+        Rolls back the pending transaction, dropping callbacks waiting for it to commit and
+        running callbacks waiting for it to roll back
+        """
+        if self._conn is not None:
+            self._conn.rollback()
+        self._after_commit = []
+        self._run_after_rollback()
+
+    def after_commit(self, callback):
+        """
+        Registers callback to be run once the pending transaction commits
+        :param callback: callable taking no arguments
+        """
+        self._after_commit.append(callback)
+
+    def after_rollback(self, callback):
+        """
+        Registers callback to be run if the pending transaction, or the transaction() block
+        it was registered in, rolls back instead of committing
+        :param callback: callable taking no arguments
+        """
+        self._after_rollback.append(callback)
+
+    def _run_after_rollback(self, pending=0):
+        """
+        Runs and drops callbacks waiting for a rollback
+        :param pending: int callbacks registered before the rolled back block, which are kept
+        """
+        callbacks = self._after_rollback[pending:]
+        del self._after_rollback[pending:]
+        for callback in callbacks:
+            callback()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Runs the enclosed block atomically inside a savepoint. Errors roll the block back and
+        are re-raised, leaving the rest of the unit of work usable. Changes are committed
+        together with the unit of work.
+        """
+        savepoint = f'uow_{self._depth}'
+        cursor = self.connection.cursor()
+        cursor.execute(f'SAVEPOINT {savepoint}')
+        self._depth += 1
+        pending_callbacks = len(self._after_commit)
+        pending_rollback_callbacks = len(self._after_rollback)
+        try:
+            yield self
+        except Exception:
+            cursor.execute(f'ROLLBACK TO SAVEPOINT {savepoint}')
+            del self._after_commit[pending_callbacks:]
+            self._run_after_rollback(pending_rollback_callbacks)
+            raise
+        else:
+            cursor.execute(f'RELEASE SAVEPOINT {savepoint}')
+        finally:
+            self._depth -= 1
+
+    def close(self):
+        """
+        Returns the connection to the pool, discarding uncommitted changes and running
+        callbacks waiting for them to roll back
+        """
+        self._after_commit = []
+        self._run_after_rollback()
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool.putconn(conn)
 
 
 class DAO:
 
     def __init__(self):
-        config = app.config['DATABASE']
-        self.conn = psycopg2.connect(dbname=config['DBNAME'], user=config['USER'],
-                                     password=config['PASSWORD'], host=config['HOST'],
-                                     port=config['PORT'])
+        self.uow = get_unit_of_work()
+
+    @property
+    def conn(self):
+        """
+        Gets connection shared by all DAOs of the current unit of work
+        :return: connection
+        """
+        return self.uow.connection
 
     def get_cursor(self):
         """
@@ -20,6 +135,59 @@ class DAO:
 
     def commit(self):
         """
-        Commits changes to database
+        Commits changes to database. Requests commit once on completion, so this is only
+        needed outside of a request, e.g. CLI commands.
         """
-        self.conn.commit()
+        self.uow.commit()
+
+    def transaction(self):
+        """
+        Gets context manager for an explicit transaction within the current unit of work
+        :return: contextmanager
+        """
+        return self.uow.transaction()
+
+
+def get_unit_of_work():
+    """
+    Gets unit of work of the current app context, creating it on first use
+    :return: UnitOfWork
+    """
+    if 'unit_of_work' not in g:
+        g.unit_of_work = UnitOfWork(get_pool(app.config))
+    return g.unit_of_work
+
+
+def transaction():
+    """
+    Gets context manager for an explicit transaction within the current unit of work
+    :return: contextmanager
+    """
+    return get_unit_of_work().transaction()
+
+
+def commit_unit_of_work(response):
+    """
+    Commits the request's unit of work once the response is ready, rolling it back for
+    server errors
+    :param response: Response
+    :return: Response
+    """
+    uow = g.get('unit_of_work')
+    if uow is not None:
+        if response.status_code >= 500:
+            uow.rollback()
+        else:
+            uow.commit()
+    return response
+
+
+def close_unit_of_work(exception=None):
+    """
+    Returns the connection of the current unit of work to the pool. Anything not committed
+    by then, e.g. after an unhandled exception, is rolled back.
+    :param exception: Exception raised during the request, if any
+    """
+    uow = g.pop('unit_of_work', None)
+    if uow is not None:
+        uow.close()
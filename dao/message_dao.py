@@ -1,6 +1,8 @@
-from dateutil.relativedelta import relativedelta
+import psycopg2.extras
 
 from dao.dao import DAO
+from utils.cache import invalidate_stats
+from utils.trending import get_tracker
 
 
 class MessageDAO(DAO):
@@ -11,24 +13,76 @@ class MessageDAO(DAO):
         :return: RealDictCursor
         """
         cursor = self.get_cursor()
-        query = 'WITH replies_query AS (SELECT replied_to, array_agg(mid) AS replies_list ' \
-                'FROM replies INNER JOIN messages ON replies.reply =  messages.mid ' \
-                'GROUP BY replied_to), ' \
-                'like_count AS (SELECT mid, COUNT(*) AS likes FROM vote ' \
-                'WHERE upvote = TRUE GROUP BY mid), ' \
-                'dislike_count AS (SELECT mid, COUNT(*) AS dislikes FROM vote ' \
-                'WHERE upvote = FALSE GROUP BY mid) ' \
-                'SELECT messages.mid, users.uid, cid, message, image, ' \
-                'COALESCE(likes, 0) AS likes, COALESCE(dislikes, 0) AS dislikes, username, ' \
-                "COALESCE(replies_list, '{}') AS replies, messages.created_on " \
-                'FROM messages LEFT OUTER JOIN like_count ON messages.mid = like_count.mid ' \
-                'LEFT OUTER JOIN dislike_count ON messages.mid = dislike_count.mid ' \
-                'LEFT OUTER JOIN photo ON messages.mid = photo.mid ' \
-                'INNER JOIN users ON messages.uid = users.uid ' \
-                'LEFT OUTER JOIN replies_query ON messages.mid = replies_query.replied_to ' \
+        query = 'SELECT messages.mid, users.uid, cid, message, messages.likes, ' \
+                'messages.dislikes, username, messages.created_on ' \
+                'FROM messages INNER JOIN users ON messages.uid = users.uid ' \
                 'ORDER BY messages.created_on DESC'
         cursor.execute(query)
-        messages = cursor.fetchall()
+        return self.load_relations(cursor.fetchall())
+
+    def search_messages(self, uid, text, cid=None, author=None, after=None, limit=20):
+        """
+        Searches the text of messages in chats user belongs to, best matches first. Pages are
+        delimited by (rank, mid) keyset cursors and one extra row is fetched so callers can
+        tell whether more matches exist.
+        :param uid: int user searching
+        :param text: str web search style query, e.g. "exact phrase" or -excluded
+        :param cid: int to only search given chat
+        :param author: int to only search messages of given user
+        :param after: tuple (rank, mid) to get matches ranked below
+        :param limit: int
+        :return: list of RealDictRow with rank
+        """
+        cursor = self.get_cursor()
+        after = after or (None, None)
+        query = 'WITH member_chats AS (SELECT cid FROM chat_members WHERE uid = %(uid)s ' \
+                'UNION SELECT cid FROM chat_group WHERE uid = %(uid)s), ' \
+                "search AS (SELECT websearch_to_tsquery('english', %(text)s) AS query), " \
+                'matches AS (SELECT messages.mid, messages.uid, messages.cid, message, ' \
+                'messages.likes, messages.dislikes, messages.created_on, ' \
+                'ts_rank(messages.search, search.query)::float8 AS rank ' \
+                'FROM messages CROSS JOIN search ' \
+                'WHERE messages.search @@ search.query ' \
+                'AND messages.cid IN (SELECT cid FROM member_chats) ' \
+                'AND (%(cid)s::int IS NULL OR messages.cid = %(cid)s) ' \
+                'AND (%(author)s::int IS NULL OR messages.uid = %(author)s)) ' \
+                'SELECT matches.mid, users.uid, cid, message, likes, dislikes, username, ' \
+                'matches.created_on, rank ' \
+                'FROM matches INNER JOIN users ON matches.uid = users.uid ' \
+                'WHERE %(after_mid)s::int IS NULL ' \
+                'OR (rank, matches.mid) < (%(after_rank)s, %(after_mid)s) ' \
+                'ORDER BY rank DESC, matches.mid DESC LIMIT %(limit)s'
+        cursor.execute(query, {'uid': uid, 'text': text, 'cid': cid, 'author': author,
+                               'after_rank': after[0], 'after_mid': after[1],
+                               'limit': limit + 1})
+        return self.load_relations(cursor.fetchall())
+
+    def load_relations(self, messages):
+        """
+        Attaches photos and replies to a page of messages. They are loaded for exactly the
+        messages of the page with one query each, so the cost only depends on the page size.
+        :param messages: list of RealDictRow with mid
+        :return: list of RealDictRow with image, image_variants, image_status and replies
+        """
+        by_mid = {}
+        for message in messages:
+            message.update(image=None, image_variants=None, image_status=None, replies=[])
+            by_mid[message['mid']] = message
+        if not by_mid:
+            return messages
+        mids = list(by_mid)
+        cursor = self.get_cursor()
+        query = "SELECT mid, CASE WHEN status = 'ready' THEN image END AS image, " \
+                "CASE WHEN status = 'ready' THEN variants END AS image_variants, " \
+                'status AS image_status FROM photo WHERE mid = ANY(%s)'
+        cursor.execute(query, (mids,))
+        for photo in cursor:
+            by_mid[photo.pop('mid')].update(photo)
+        query = 'SELECT replied_to, reply FROM replies WHERE replied_to = ANY(%s) ' \
+                'ORDER BY replied_to, reply'
+        cursor.execute(query, (mids,))
+        for reply in cursor:
+            by_mid[reply['replied_to']]['replies'].append(reply['reply'])
         return messages
 
     def get_message(self, mid):
@@ -38,33 +92,93 @@ class MessageDAO(DAO):
         :return: RealDictCursor
         """
         cursor = self.get_cursor()
-        query = 'WITH like_count AS (SELECT mid, COUNT(*) AS likes ' \
-                'FROM vote WHERE upvote = TRUE GROUP BY mid), ' \
-                'dislike_count AS (SELECT mid, COUNT(*) AS dislikes ' \
-                'FROM vote WHERE upvote = FALSE GROUP BY mid),' \
-                'replies_query AS (SELECT replied_to, array_agg(mid) AS replies_list ' \
-                'FROM replies INNER JOIN messages ON replies.reply =  messages.mid ' \
-                'GROUP BY replied_to) ' \
-                'SELECT messages.mid, cid, message, image, COALESCE(likes, 0) AS likes, ' \
-                'COALESCE(dislikes, 0) AS dislikes, username, ' \
-                "COALESCE(replies_list, '{}') AS replies " \
+        query = 'WITH replies_query AS (SELECT replied_to, array_agg(reply) AS replies_list ' \
+                'FROM replies WHERE replied_to = %s GROUP BY replied_to) ' \
+                'SELECT messages.mid, cid, message, ' \
+                "CASE WHEN photo.status = 'ready' THEN image END AS image, " \
+                "CASE WHEN photo.status = 'ready' THEN variants END AS image_variants, " \
+                'photo.status AS image_status, messages.likes, messages.dislikes, username, ' \
+                "COALESCE(replies_list, '{}') AS replies, " \
                 'messages.created_on FROM messages ' \
-                'LEFT OUTER JOIN like_count ON messages.mid = like_count.mid ' \
-                'LEFT OUTER JOIN dislike_count ON messages.mid = dislike_count.mid ' \
                 'LEFT OUTER JOIN photo ON messages.mid = photo.mid ' \
                 'INNER JOIN users ON messages.uid = users.uid ' \
                 'LEFT OUTER JOIN replies_query ON messages.mid = replies_query.replied_to ' \
                 'WHERE messages.mid = %s ORDER BY messages.created_on DESC'
-        cursor.execute(query, (mid,))
+        cursor.execute(query, (mid, mid))
         messages = cursor.fetchall()
         return messages
 
-    def get_message_replies(self, mid):
+    def get_message_cid(self, mid):
+        """
+        Gets id of the chat message belongs to
+        :param mid: int
+        :return: int, None if message does not exist
+        """
+        cursor = self.get_cursor()
+        query = 'SELECT cid FROM messages WHERE mid = %s'
+        cursor.execute(query, (mid,))
+        message = cursor.fetchone()
+        return message['cid'] if message else None
+
+    def get_message_updated_on(self, mid):
+        """
+        Gets when message or its votes, replies or photo last changed
+        :param mid: int
+        :return: datetime, None if message does not exist
+        """
+        cursor = self.get_cursor()
+        query = 'SELECT updated_on FROM messages WHERE mid = %s'
+        cursor.execute(query, (mid,))
+        message = cursor.fetchone()
+        return message['updated_on'] if message else None
+
+    def get_message_replies(self, mid, depth=3, fanout=20, after=None):
         """
-        Gets messages that are replies to specified message
+        Gets the thread of replies under specified message in a single recursive query. Every
+        message contributes at most fanout replies, oldest first, down to given depth. Direct
+        replies are paginated by (created_on, mid) keyset cursors and one extra direct reply is
+        fetched, without its own replies, so callers can tell whether more exist. Deeper levels
+        are paginated by getting the replies of the message they belong to.
         :param mid: int
+        :param depth: int levels of replies to get
+        :param fanout: int replies to get per message
+        :param after: tuple (created_on, mid) to get direct replies newer than
+        :return: RealDictCursor ordered so replies come after the message they reply to
         """
-        pass
+        cursor = self.get_cursor()
+        after = after or (None, None)
+        query = 'WITH RECURSIVE thread AS (' \
+                'SELECT mid, replied_to, 1 AS depth, position, ' \
+                'ARRAY[position] AS path FROM (' \
+                'SELECT messages.mid, replies.replied_to, row_number() OVER ' \
+                '(ORDER BY messages.created_on, messages.mid) AS position ' \
+                'FROM replies INNER JOIN messages ON replies.reply = messages.mid ' \
+                'WHERE replies.replied_to = %(mid)s AND (%(after_mid)s::int IS NULL ' \
+                'OR (messages.created_on, messages.mid) > (%(after_created_on)s, %(after_mid)s)) ' \
+                'ORDER BY messages.created_on, messages.mid LIMIT %(fanout)s + 1) AS direct ' \
+                'UNION ALL ' \
+                'SELECT child.mid, child.replied_to, thread.depth + 1, child.position, ' \
+                'thread.path || child.position FROM thread CROSS JOIN LATERAL (' \
+                'SELECT messages.mid, replies.replied_to, row_number() OVER ' \
+                '(ORDER BY messages.created_on, messages.mid) AS position ' \
+                'FROM replies INNER JOIN messages ON replies.reply = messages.mid ' \
+                'WHERE replies.replied_to = thread.mid ' \
+                'ORDER BY messages.created_on, messages.mid LIMIT %(fanout)s) AS child ' \
+                'WHERE thread.depth < %(depth)s AND thread.position <= %(fanout)s) ' \
+                'SELECT messages.mid, thread.replied_to, thread.depth, messages.cid, ' \
+                'users.uid, username, message, ' \
+                "CASE WHEN photo.status = 'ready' THEN image END AS image, " \
+                "CASE WHEN photo.status = 'ready' THEN variants END AS image_variants, " \
+                'photo.status AS image_status, messages.likes, messages.dislikes, ' \
+                '(SELECT COUNT(*) FROM replies WHERE replies.replied_to = messages.mid) ' \
+                'AS num_replies, messages.created_on, messages.updated_on ' \
+                'FROM thread INNER JOIN messages ON thread.mid = messages.mid ' \
+                'INNER JOIN users ON messages.uid = users.uid ' \
+                'LEFT OUTER JOIN photo ON messages.mid = photo.mid ' \
+                'ORDER BY thread.path'
+        cursor.execute(query, {'mid': mid, 'depth': depth, 'fanout': fanout,
+                               'after_created_on': after[0], 'after_mid': after[1]})
+        return cursor.fetchall()
 
     def get_likes_message(self, mid):
         """
@@ -73,7 +187,7 @@ class MessageDAO(DAO):
         :return: RealDictCursor
         """
         cursor = self.get_cursor()
-        query = 'SELECT count(*) FROM vote WHERE mid = %s AND upvote = TRUE'
+        query = 'SELECT likes AS count FROM messages WHERE mid = %s'
         cursor.execute(query, (mid,))
         return cursor.fetchall()
 
@@ -107,124 +221,111 @@ class MessageDAO(DAO):
 
     def vote_message(self, mid, uid, upvote):
         """
-        Likes/Dislikes a message
+        Likes/Dislikes a message. Casting the same vote again removes it and casting the
+        opposite vote changes it. The chat version is incremented first, which locks the chat
+        until commit, so concurrent votes on its messages wait for each other and always read
+        the vote they replace. Message counters and activity rollups are then updated together
+        with the vote, the message is marked changed and the chat is notified of the new
+        counters on commit.
         :param mid: int
         :param uid: int
         :param upvote: bool
+        :return: RealDictRow with previous and current upvote (None for no vote) and the
+        new likes/dislikes counters, None if message does not exist
         """
         cursor = self.get_cursor()
-        query = 'INSERT into vote (mid, uid, upvote) values (%s, %s, %s)'
-        cursor.execute(query, (mid, uid, upvote,))
-        self.commit()
-
-    def get_num_messages_daily(self, date):
-        """
-        Gets daily number of messages
-        :param date: datetime
-        :return: RealDictCursor
-        """
-        cursor = self.get_cursor()
-        end_date = date + relativedelta(days=1)
-        query = 'SELECT count(*) AS num FROM messages WHERE created_on > %s AND created_on < %s'
-        cursor.execute(query, (date, end_date))
-        count = cursor.fetchall()
-        return count[0]['num']
-
-    def get_num_likes_daily(self, date, like):
-        """
-        Gets daily number of likes
-        :param date: datetime
-        :param like: bool
-        :return: RealDictCursor
-        """
-        cursor = self.get_cursor()
-        end_date = date + relativedelta(days=1)
-        query = 'SELECT count(*) AS num ' \
-                'FROM vote ' \
-                'WHERE voted_on > %s AND voted_on < %s AND upvote = %s'
-        cursor.execute(query, (date, end_date, like))
-        count = cursor.fetchall()
-        return count[0]['num']
+        if not self._bump_chat_versions(cursor, mids=[mid]):
+            return None
+        # Runs with a snapshot taken after the chat lock, seeing votes committed meanwhile
+        query = 'WITH previous AS (SELECT upvote, voted_on FROM vote ' \
+                'WHERE mid = %(mid)s AND uid = %(uid)s), ' \
+                'removed AS (DELETE FROM vote WHERE mid = %(mid)s AND uid = %(uid)s ' \
+                'AND upvote = %(upvote)s RETURNING upvote), ' \
+                'cast_vote AS (INSERT INTO vote (mid, uid, upvote) ' \
+                'SELECT %(mid)s, %(uid)s, %(upvote)s ' \
+                'WHERE NOT EXISTS (SELECT 1 FROM removed) ' \
+                'ON CONFLICT (mid, uid) DO UPDATE SET upvote = EXCLUDED.upvote ' \
+                'RETURNING upvote, voted_on), ' \
+                'counts AS (UPDATE messages SET updated_on = now(), version = ' \
+                '(SELECT version FROM chat_group WHERE chat_group.cid = messages.cid), ' \
+                'likes = likes + (SELECT COUNT(*) FILTER (WHERE upvote) FROM cast_vote) ' \
+                '- (SELECT COUNT(*) FILTER (WHERE upvote) FROM previous), ' \
+                'dislikes = dislikes ' \
+                '+ (SELECT COUNT(*) FILTER (WHERE NOT upvote) FROM cast_vote) ' \
+                '- (SELECT COUNT(*) FILTER (WHERE NOT upvote) FROM previous) ' \
+                'WHERE mid = %(mid)s RETURNING cid, likes, dislikes), ' \
+                "vote_changes AS (SELECT date_trunc('hour', voted_on) AS hour, upvote, " \
+                '-1 AS delta FROM previous ' \
+                "UNION ALL SELECT date_trunc('hour', voted_on), upvote, 1 FROM cast_vote), " \
+                'rollup AS (INSERT INTO activity_rollup (hour, metric, mid, uid, total) ' \
+                "SELECT hour, CASE WHEN upvote THEN 'likes' ELSE 'dislikes' END, key, 0, " \
+                'SUM(delta) FROM vote_changes CROSS JOIN (VALUES (0), (%(mid)s)) AS keys (key) ' \
+                'GROUP BY 1, 2, 3 HAVING SUM(delta) <> 0 ' \
+                'ON CONFLICT (metric, mid, uid, hour) ' \
+                'DO UPDATE SET total = activity_rollup.total + EXCLUDED.total) ' \
+                'SELECT (SELECT upvote FROM previous) AS previous, ' \
+                '(SELECT upvote FROM cast_vote) AS upvote, likes, dislikes, ' \
+                "pg_notify('chat_' || cid, json_build_object('type', 'vote', " \
+                "'mid', %(mid)s::int, 'likes', likes, 'dislikes', dislikes)::text) AS notified " \
+                'FROM counts'
+        cursor.execute(query, {'mid': mid, 'uid': uid, 'upvote': upvote})
+        self.uow.after_commit(lambda: invalidate_stats('votes'))
+        return cursor.fetchone()
 
-    def get_num_replies_daily(self, date):
+    def insert_message(self, cid, uid, message, img=None, replied_to=None):
         """
-        Gets daily number of replies
-        :param date: datetime
-        :return: RealDictCursor
-        """
-        cursor = self.get_cursor()
-        end_date = date + relativedelta(days=1)
-        query = 'SELECT count(*) AS num ' \
-                'FROM replies INNER JOIN messages ON messages.mid = replies.replied_to' \
-                ' WHERE created_on > %s AND created_on < %s'
-        cursor.execute(query, (date, end_date))
-        count = cursor.fetchall()
-        return count[0]['num']
-
-    def get_num_replies_photos_daily(self, pid, date):
-        """
-        Gets daily number of replies for replies containing images
-        :param pid: int
-        :param date: datetime
-        :return: RealDictCursor
-        """
-        cursor = self.get_cursor()
-        end_date = date + relativedelta(days=1)
-        query = 'SELECT count(*) AS num ' \
-                'FROM replies INNER JOIN messages ON messages.mid = replies.replied_to ' \
-                'WHERE replies.replied_to = %s AND created_on > %s AND created_on < %s'
-        cursor.execute(query, (pid, date, end_date,))
-        count = cursor.fetchall()
-        return count[0]['num']
-
-    def get_num_like_photos_daily(self, pid, date, like):
-        """
-        Gets daily number of likes for images
-        :param pid: int
-        :param date: datetime
-        :param like: bool
-        :return: RealDictCursor
-        """
-        cursor = self.get_cursor()
-        end_date = date + relativedelta(days=1)
-        query = 'SELECT count(*) AS num FROM vote WHERE vote.mid = %s ' \
-                'AND vote.upvote = %s AND voted_on > %s AND voted_on < %s'
-        cursor.execute(query, (pid, like, date, end_date,))
-        count = cursor.fetchall()
-        return count[0]['num']
-
-    def get_trending_hashtags(self):
-        """
-        Gets trending hashtags
-        :return: RealDictCursor
-        """
-        cursor = self.get_cursor()
-        query = 'SELECT count(*) AS num, hashtag ' \
-                'FROM hashtags_messages NATURAL INNER JOIN messages ' \
-                'group by hashtag order by num desc limit 10'
-        cursor.execute(query)
-        return cursor.fetchall()
-
-    def insert_message(self, cid, uid, message, img=None):
-        """
-        Inserts new message to database
+        Inserts new message to database together with its photo, hashtags, reply link and
+        activity rollups. The chat version is incremented first and stamped on the message and
+        the replied message, which is marked changed. The chat is notified of the message on
+        commit.
         :param cid: int
         :param uid: int
         :param message: str
-        :param img: str
+        :param img: str spooled filename of image waiting to be uploaded
+        :param replied_to: int id of the message being replied to
         :return: int
         """
         cursor = self.get_cursor()
-        query = 'INSERT INTO messages (cid, uid, message) VALUES(%s, %s, %s) RETURNING mid'
-        cursor.execute(query, (cid, uid, message))
+        hashtags = [word for word in message.split() if word.startswith('#')]
+        self._bump_chat_versions(cursor, cids=[cid], mids=[replied_to] if replied_to else [])
+        query = 'WITH new_message AS (INSERT INTO messages (cid, uid, message, version) ' \
+                'VALUES (%(cid)s, %(uid)s, %(message)s, ' \
+                '(SELECT version FROM chat_group WHERE cid = %(cid)s)) ' \
+                'RETURNING mid, cid, uid, message, created_on), ' \
+                "new_photo AS (INSERT INTO photo (image, mid, status) " \
+                "SELECT %(img)s, mid, 'pending' FROM new_message WHERE %(img)s IS NOT NULL), " \
+                'new_hashtags AS (INSERT INTO hashtags_messages (hashtag, mid) ' \
+                'SELECT hashtag, mid ' \
+                'FROM new_message, unnest(%(hashtags)s::varchar[]) AS hashtag), ' \
+                'new_reply AS (INSERT INTO replies (replied_to, reply) ' \
+                'SELECT %(replied_to)s, mid FROM new_message WHERE %(replied_to)s IS NOT NULL), ' \
+                'replied_message AS (UPDATE messages SET updated_on = now(), version = ' \
+                '(SELECT version FROM chat_group WHERE chat_group.cid = messages.cid) ' \
+                'WHERE mid = %(replied_to)s), ' \
+                'rollup AS (INSERT INTO activity_rollup (hour, metric, mid, uid, total) ' \
+                "SELECT date_trunc('hour', CURRENT_TIMESTAMP), metric, mid, uid, 1 " \
+                "FROM (VALUES ('messages', 0, 0), ('posts', 0, %(uid)s), " \
+                "('replies', 0, 0), ('replies', %(replied_to)s, 0)) " \
+                'AS activity (metric, mid, uid) ' \
+                "WHERE metric <> 'replies' OR %(replied_to)s IS NOT NULL " \
+                'ON CONFLICT (metric, mid, uid, hour) ' \
+                'DO UPDATE SET total = activity_rollup.total + EXCLUDED.total) ' \
+                "SELECT mid, pg_notify('chat_' || cid, json_build_object('type', 'message', " \
+                "'mid', mid, 'cid', cid, 'uid', uid, 'message', message, " \
+                "'replied_to', %(replied_to)s::int, 'created_on', created_on, " \
+                "'image_status', CASE WHEN %(img)s IS NOT NULL THEN 'pending' END)::text) " \
+                'AS notified FROM new_message'
+        cursor.execute(query, {'cid': cid, 'uid': uid, 'message': message, 'img': img,
+                               'hashtags': hashtags, 'replied_to': replied_to})
         message_id = cursor.fetchone()['mid']
-        if img:
-            query = 'INSERT INTO photo (image, mid) VALUES (%s, %s)'
-            cursor.execute(query, (img, message_id))
-        hastags = [mess for mess in message.split() if mess.startswith('#')]
-        for hashtag in hastags:
-            self.insert_hashtag(hashtag, message_id)
-        cursor.connection.commit()
+        stale_stats = ['messages']
+        if replied_to is not None:
+            stale_stats.append('replies')
+        if hashtags:
+            tracker = get_tracker()
+            self.uow.after_commit(lambda: tracker.record(hashtags))
+            stale_stats.append('hashtags')
+        self.uow.after_commit(lambda: invalidate_stats(*stale_stats))
         return message_id
 
     def insert_reply(self, message, uid, mid, cid, img=None):
@@ -234,48 +335,73 @@ class MessageDAO(DAO):
         :param uid: int
         :param mid: int
         :param cid: int
-        :param img: str
+        :param img: str spooled filename of image waiting to be uploaded
         :return: int
         """
-        cursor = self.get_cursor()
-        rid = self.insert_message(cid, uid, message, img=img)
-        query = 'INSERT INTO replies (replied_to, reply) values (%s, %s) RETURNING reply'
-        cursor.execute(query, (mid, rid))
-        reply_id = cursor.fetchone()['reply']
-        self.commit()
-        return reply_id
+        return self.insert_message(cid, uid, message, img=img, replied_to=mid)
 
-    def insert_hashtag(self, hashtag, mid):
+    def update_photo(self, mid, image, variants=None):
         """
-        Inserts a new hashtag to the database
-        :param hashtag: str
+        Records outcome of uploading the pending photo of a message, marks the message changed
+        with a new chat version and notifies its chat
         :param mid: int
+        :param image: str url of uploaded image, None if the upload failed
+        :param variants: dict mapping variant name to url of the resized image
         """
         cursor = self.get_cursor()
-        query = 'INSERT INTO hashtags_messages (hashtag, mid) values (%s, %s)'
-        cursor.execute(query, (hashtag, mid))
-        self.commit()
+        self._bump_chat_versions(cursor, mids=[mid])
+        query = 'WITH updated AS (UPDATE photo SET image = COALESCE(%s, image), variants = %s, ' \
+                "status = CASE WHEN %s IS NULL THEN 'failed' ELSE 'ready' END " \
+                "WHERE mid = %s AND status <> 'ready' RETURNING mid, image, variants, status), " \
+                'touched AS (UPDATE messages SET updated_on = now(), version = ' \
+                '(SELECT version FROM chat_group WHERE chat_group.cid = messages.cid) ' \
+                'FROM updated WHERE messages.mid = updated.mid) ' \
+                "SELECT pg_notify('chat_' || cid, json_build_object('type', 'photo', " \
+                "'mid', mid, 'image_status', status, " \
+                "'image', CASE WHEN status = 'ready' THEN image END, " \
+                "'image_variants', CASE WHEN status = 'ready' THEN variants END)::text) " \
+                'FROM updated INNER JOIN messages USING (mid)'
+        cursor.execute(query, (image, psycopg2.extras.Json(variants or {}), image, mid))
 
-    def remove_vote(self, mid, uid, upvote):
+    def _bump_chat_versions(self, cursor, cids=(), mids=()):
+        """
+        Increments the version of chats, locking them until commit. Writers call this before
+        changing messages and stamp the new version on them, so versions of a chat's messages
+        follow the order their changes commit in.
+        :param cursor: RealDictCursor
+        :param cids: list of chat ids
+        :param mids: list of ids of messages whose chats are incremented
+        :return: list of RealDictRow with cid and new version
+        """
+        query = 'UPDATE chat_group SET version = version + 1 WHERE cid = ANY(%s) ' \
+                'OR cid IN (SELECT cid FROM messages WHERE mid = ANY(%s)) RETURNING cid, version'
+        cursor.execute(query, (list(cids), list(mids)))
+        return cursor.fetchall()
+
+    def get_unfinished_photos(self):
         """
-        Updates/Deletes upvote column to remove a like/dislike
-        :param mid: int
-        :param uid: int
-        :param upvote: bool
-        :return: bool
+        Gets photos whose upload is pending or failed together with their spooled filename
+        :return: RealDictCursor
         """
         cursor = self.get_cursor()
-        query = 'SELECT * FROM vote WHERE mid = %s AND uid = %s'
-        cursor.execute(query, (mid, uid))
-        vote = [vote for vote in cursor.fetchall()]
-        delete = vote[0]['upvote'] == upvote
-
-        if delete:
-            query = 'DELETE FROM vote WHERE mid = %s AND uid = %s'
-            cursor.execute(query, (mid, uid))
+        query = "SELECT mid, image FROM photo WHERE status <> 'ready'"
+        cursor.execute(query)
+        return cursor.fetchall()
 
-        else:
-            query = 'UPDATE vote SET upvote = %s WHERE mid = %s AND uid = %s'
-            cursor.execute(query, (upvote, mid, uid))
-        self.commit()
-        return delete
+    def reconcile_vote_counts(self):
+        """
+        Rebuilds like/dislike counters of every message from the vote table
+        :return: int number of messages whose counters were corrected
+        """
+        cursor = self.get_cursor()
+        query = 'WITH vote_count AS (SELECT messages.mid, ' \
+                'COUNT(vote.mid) FILTER (WHERE vote.upvote) AS likes, ' \
+                'COUNT(vote.mid) FILTER (WHERE NOT vote.upvote) AS dislikes ' \
+                'FROM messages LEFT OUTER JOIN vote ON messages.mid = vote.mid ' \
+                'GROUP BY messages.mid) ' \
+                'UPDATE messages SET likes = vote_count.likes, dislikes = vote_count.dislikes ' \
+                'FROM vote_count WHERE messages.mid = vote_count.mid ' \
+                'AND (messages.likes, messages.dislikes) ' \
+                'IS DISTINCT FROM (vote_count.likes, vote_count.dislikes)'
+        cursor.execute(query)
+        return cursor.rowcount
@@ -0,0 +1,116 @@
+import os
+import threading
+
+import psycopg2
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+
+_POOL = None
+_POOL_PID = None
+_POOL_LOCK = threading.Lock()
+
+
+def connection_params(database):
+    """
+    Gets psycopg2 connection parameters from database config
+    :param database: dict with DBNAME, USER, PASSWORD, HOST and PORT keys
+    :return: dict
+    """
+    return {'dbname': database['DBNAME'], 'user': database['USER'],
+            'password': database['PASSWORD'], 'host': database['HOST'],
+            'port': database['PORT']}
+
+
+class PoolTimeout(PoolError):
+    """
+    Raised when no connection could be checked out before the configured timeout
+    """
+
+
+class ConnectionPool:
+
+    def __init__(self, database, min_size=1, max_size=10, timeout=5, pre_ping=True):
+        """
+        Thread safe pool of psycopg2 connections
+        :param database: dict with DBNAME, USER, PASSWORD, HOST and PORT keys
+        :param min_size: int
+        :param max_size: int
+        :param timeout: float seconds to wait for a free connection
+        :param pre_ping: bool checks connection health on checkout
+        """
+        self.timeout = timeout
+        self.pre_ping = pre_ping
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._pool = ThreadedConnectionPool(min_size, max_size, **connection_params(database))
+
+    def getconn(self):
+        """
+        Checks out a connection from the pool, waiting up to timeout seconds for one to be free
+        :return: connection
+        """
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolTimeout(f'No database connection available after {self.timeout}s')
+        try:
+            conn = self._pool.getconn()
+            if self.pre_ping and not self._is_alive(conn):
+                self._pool.putconn(conn, close=True)
+                conn = self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+        return conn
+
+    def putconn(self, conn):
+        """
+        Returns connection to the pool. Open transactions are rolled back and broken
+        connections are discarded.
+        :param conn: connection
+        """
+        try:
+            self._pool.putconn(conn, close=bool(conn.closed))
+        finally:
+            self._slots.release()
+
+    def closeall(self):
+        """
+        Closes every connection held by the pool
+        """
+        self._pool.closeall()
+
+    @staticmethod
+    def _is_alive(conn):
+        """
+        Pings the server through given connection
+        :param conn: connection
+        :return: bool
+        """
+        if conn.closed:
+            return False
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+
+def get_pool(config):
+    """
+    Gets the connection pool of the current process, creating it on first use. Pools are
+    never shared across forks so every gunicorn worker keeps its own warm connections.
+    :param config: app config
+    :return: ConnectionPool
+    """
+    global _POOL, _POOL_PID
+    pid = os.getpid()
+    if _POOL is None or _POOL_PID != pid:
+        with _POOL_LOCK:
+            if _POOL is None or _POOL_PID != pid:
+                pool_config = config['DATABASE_POOL']
+                _POOL = ConnectionPool(config['DATABASE'],
+                                       min_size=pool_config['MIN_SIZE'],
+                                       max_size=pool_config['MAX_SIZE'],
+                                       timeout=pool_config['TIMEOUT'],
+                                       pre_ping=pool_config['PRE_PING'])
+                _POOL_PID = pid
+    return _POOL
@@ -0,0 +1,108 @@
+from dao.dao import DAO
+
+# Hourly activity_rollup rows backing each metric: rollup metric name and the rollup column
+# holding the mid/uid the series is restricted to
+ROLLUP_METRICS = {
+    'messages': ('messages', None),
+    'likes': ('likes', 'mid'),
+    'dislikes': ('dislikes', 'mid'),
+    'replies': ('replies', 'mid'),
+    'user_messages': ('posts', 'uid'),
+}
+
+BUCKETS = ('hour', 'day', 'week')
+
+
+class StatsDAO(DAO):
+
+    def get_metric_series(self, metric, start, end, bucket, key=None):
+        """
+        Counts events of given metric per time bucket in a single grouped query over hourly
+        activity rollups. Every bucket between start and end is returned, newest first, with
+        0 for empty buckets.
+        :param metric: str one of ROLLUP_METRICS
+        :param start: datetime
+        :param end: datetime
+        :param bucket: str one of BUCKETS
+        :param key: int mid/uid the metric is restricted to, if any
+        :return: RealDictCursor
+        """
+        rollup_metric, key_column = ROLLUP_METRICS[metric]
+        keys = {'mid': 0, 'uid': 0}
+        if key is not None and key_column:
+            keys[key_column] = key
+        cursor = self.get_cursor()
+        query = 'WITH buckets AS (SELECT generate_series(' \
+                'date_trunc(%(bucket)s, %(start)s::timestamptz), ' \
+                'date_trunc(%(bucket)s, %(end)s::timestamptz), %(step)s::interval) AS day), ' \
+                'events AS (SELECT date_trunc(%(bucket)s, hour) AS day, ' \
+                'SUM(total) AS total FROM activity_rollup ' \
+                'WHERE metric = %(metric)s AND mid = %(mid)s AND uid = %(uid)s ' \
+                'AND hour >= date_trunc(%(bucket)s, %(start)s::timestamptz) ' \
+                'AND hour < date_trunc(%(bucket)s, %(end)s::timestamptz) + %(step)s::interval ' \
+                'GROUP BY 1) ' \
+                'SELECT buckets.day, COALESCE(events.total, 0) AS total ' \
+                'FROM buckets LEFT OUTER JOIN events ON buckets.day = events.day ' \
+                'ORDER BY buckets.day DESC'
+        cursor.execute(query, {'bucket': bucket, 'start': start, 'end': end,
+                               'step': f'1 {bucket}', 'metric': rollup_metric, **keys})
+        return cursor.fetchall()
+
+    def get_active_users_series(self, start, end, bucket, limit=10):
+        """
+        Gets the users who posted the most messages per time bucket in a single query over
+        hourly activity rollups
+        :param start: datetime
+        :param end: datetime
+        :param bucket: str one of BUCKETS
+        :param limit: int number of users per bucket
+        :return: RealDictCursor
+        """
+        cursor = self.get_cursor()
+        query = 'WITH buckets AS (SELECT generate_series(' \
+                'date_trunc(%(bucket)s, %(start)s::timestamptz), ' \
+                'date_trunc(%(bucket)s, %(end)s::timestamptz), %(step)s::interval) AS day), ' \
+                'activity AS (SELECT date_trunc(%(bucket)s, hour) AS day, uid, ' \
+                'SUM(total) AS amount FROM activity_rollup ' \
+                "WHERE metric = 'posts' AND mid = 0 " \
+                'AND hour >= date_trunc(%(bucket)s, %(start)s::timestamptz) ' \
+                'AND hour < date_trunc(%(bucket)s, %(end)s::timestamptz) + %(step)s::interval ' \
+                'GROUP BY 1, 2 HAVING SUM(total) > 0), ' \
+                'ranked AS (SELECT day, uid, ROW_NUMBER() OVER ' \
+                '(PARTITION BY day ORDER BY amount DESC, uid) AS position FROM activity) ' \
+                'SELECT buckets.day, COALESCE(json_agg(json_build_object(' \
+                "'username', users.username) ORDER BY ranked.position) " \
+                "FILTER (WHERE users.username IS NOT NULL), '[]') AS users " \
+                'FROM buckets LEFT OUTER JOIN ranked ' \
+                'ON buckets.day = ranked.day AND ranked.position <= %(limit)s ' \
+                'LEFT OUTER JOIN users ON ranked.uid = users.uid ' \
+                'GROUP BY buckets.day ORDER BY buckets.day DESC'
+        cursor.execute(query, {'bucket': bucket, 'start': start, 'end': end,
+                               'step': f'1 {bucket}', 'limit': limit})
+        return cursor.fetchall()
+
+    def rebuild_rollups(self):
+        """
+        Rebuilds every activity rollup from the messages, replies and vote tables
+        :return: int number of rollup rows written
+        """
+        cursor = self.get_cursor()
+        cursor.execute('TRUNCATE activity_rollup')
+        query = 'INSERT INTO activity_rollup (hour, metric, mid, uid, total) ' \
+                "SELECT date_trunc('hour', created_on), 'messages', 0, 0, COUNT(*) " \
+                'FROM messages GROUP BY 1 ' \
+                "UNION ALL SELECT date_trunc('hour', created_on), 'posts', 0, uid, COUNT(*) " \
+                'FROM messages WHERE uid IS NOT NULL GROUP BY 1, 4 ' \
+                "UNION ALL SELECT date_trunc('hour', messages.created_on), 'replies', 0, 0, " \
+                'COUNT(*) FROM replies INNER JOIN messages ON messages.mid = replies.reply ' \
+                'GROUP BY 1 ' \
+                "UNION ALL SELECT date_trunc('hour', messages.created_on), 'replies', " \
+                'replies.replied_to, 0, COUNT(*) ' \
+                'FROM replies INNER JOIN messages ON messages.mid = replies.reply ' \
+                'GROUP BY 1, 3 ' \
+                "UNION ALL SELECT date_trunc('hour', voted_on), CASE WHEN upvote THEN 'likes' " \
+                "ELSE 'dislikes' END, 0, 0, COUNT(*) FROM vote GROUP BY 1, 2 " \
+                "UNION ALL SELECT date_trunc('hour', voted_on), CASE WHEN upvote THEN 'likes' " \
+                "ELSE 'dislikes' END, mid, 0, COUNT(*) FROM vote GROUP BY 1, 2, 3"
+        cursor.execute(query)
+        return cursor.rowcount
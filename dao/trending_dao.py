@@ -0,0 +1,57 @@
+import psycopg2.extras
+
+from dao.dao import DAO
+
+
+class TrendingDAO(DAO):
+
+    def save_snapshot(self, worker, window, counts, taken_at):
+        """
+        Saves the trending hashtag counts of a worker for given window
+        :param worker: str
+        :param window: str
+        :param counts: dict mapping hashtag to decayed count
+        :param taken_at: float epoch seconds counts are decayed to
+        """
+        cursor = self.get_cursor()
+        query = 'INSERT INTO trending_snapshot (worker, window_name, taken_on, counts) ' \
+                'VALUES (%s, %s, to_timestamp(%s), %s) ' \
+                'ON CONFLICT (worker, window_name) ' \
+                'DO UPDATE SET taken_on = EXCLUDED.taken_on, counts = EXCLUDED.counts'
+        cursor.execute(query, (worker, window, taken_at, psycopg2.extras.Json(counts)))
+
+    def get_snapshots(self, exclude_worker):
+        """
+        Gets trending hashtag counts saved by every other worker
+        :param exclude_worker: str
+        :return: RealDictCursor
+        """
+        cursor = self.get_cursor()
+        query = 'SELECT worker, window_name, extract(epoch FROM taken_on) AS taken_at, counts ' \
+                'FROM trending_snapshot WHERE worker <> %s'
+        cursor.execute(query, (exclude_worker,))
+        return cursor.fetchall()
+
+    def delete_snapshots(self, taken_before):
+        """
+        Deletes snapshots whose counts have decayed away
+        :param taken_before: float epoch seconds
+        """
+        cursor = self.get_cursor()
+        query = 'DELETE FROM trending_snapshot WHERE taken_on < to_timestamp(%s)'
+        cursor.execute(query, (taken_before,))
+
+    def get_hashtag_history(self, since):
+        """
+        Gets number of times each hashtag was used per hour since given time
+        :param since: float epoch seconds
+        :return: RealDictCursor
+        """
+        cursor = self.get_cursor()
+        query = "SELECT hashtag, extract(epoch FROM date_trunc('hour', created_on)) AS used_at, " \
+                'COUNT(*) AS num ' \
+                'FROM hashtags_messages INNER JOIN messages ' \
+                'ON hashtags_messages.mid = messages.mid ' \
+                'WHERE messages.created_on >= to_timestamp(%s) GROUP BY 1, 2'
+        cursor.execute(query, (since,))
+        return cursor.fetchall()
@@ -1,5 +1,3 @@
-from dateutil.relativedelta import relativedelta
-
 from dao.dao import DAO
 
 
@@ -22,7 +20,6 @@ class UserDAO(DAO):
                 'VALUES (%s,%s,%s,%s,%s,%s) returning uid'
         cursor.execute(query, (username, password, first_name, last_name, email, phone_number,))
         uid = cursor.fetchone()['uid']
-        self.commit()
         return uid
 
     def get_all_users(self):
@@ -36,6 +33,28 @@ class UserDAO(DAO):
         cursor.execute(query)
         return cursor.fetchall()
 
+    def search_users(self, text, limit=10, contacts_of=None):
+        """
+        Searches users whose username, names or email contain text or a word similar to it,
+        users whose username starts with it first, then closest matches
+        :param text: str
+        :param limit: int
+        :param contacts_of: int to only search contacts of given user
+        :return: RealDictCursor
+        """
+        cursor = self.get_cursor()
+        text = text.lower()
+        escaped = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        query = 'SELECT uid, username, first_name, last_name FROM users ' \
+                'WHERE (search_text LIKE %(pattern)s OR %(text)s <%% search_text) ' \
+                'AND (%(owner)s::int IS NULL OR uid IN ' \
+                '(SELECT contact_id FROM contacts WHERE owner_id = %(owner)s)) ' \
+                'ORDER BY lower(username) LIKE %(prefix)s DESC, ' \
+                'word_similarity(%(text)s, search_text) DESC, username LIMIT %(limit)s'
+        cursor.execute(query, {'text': text, 'pattern': f'%{escaped}%', 'prefix': f'{escaped}%',
+                               'owner': contacts_of, 'limit': limit})
+        return cursor.fetchall()
+
     def get_user(self, uid):
         """
         Gets user from database
@@ -61,6 +80,19 @@ class UserDAO(DAO):
         cursor.execute(query, (uid,))
         return cursor.fetchall()
 
+    def get_unknown_uids(self, uids):
+        """
+        Gets which of given user ids belong to no user
+        :param uids: list of int
+        :return: list of int
+        """
+        cursor = self.get_cursor()
+        query = 'SELECT given.uid FROM unnest(%s::int[]) AS given (uid) ' \
+                'WHERE NOT EXISTS (SELECT 1 FROM users WHERE users.uid = given.uid) ' \
+                'ORDER BY given.uid'
+        cursor.execute(query, (list(uids),))
+        return [row['uid'] for row in cursor]
+
     def get_user_by_username(self, username):
         """
         Queries DB for information on given username
@@ -74,6 +106,56 @@ class UserDAO(DAO):
         cursor.execute(query, (username,))
         return cursor.fetchall()[0] if cursor.rowcount > 0 else None
 
+    def get_username_holder(self, username):
+        """
+        Gets uid of the user holding username and since when they hold it
+        :param username: str
+        :return: RealDictCursor with uid and since in seconds since the epoch, None if no
+        user holds username
+        """
+        cursor = self.get_cursor()
+        query = 'SELECT uid, EXTRACT(EPOCH FROM username_since)::float8 AS since ' \
+                'FROM users ' \
+                'WHERE username = %s'
+        cursor.execute(query, (username,))
+        return cursor.fetchone()
+
+    def update_username(self, uid, new_username):
+        """
+        Changes username of user, notifying workers of the released username on commit.
+        Usernames show in chats, messages and their likers, so the chats the user owns, belongs
+        to or posted in are incremented first, locking them in order like other chat writers
+        do, and the user's messages and messages they voted on are marked changed.
+        :param uid: int
+        :param new_username: str
+        :return: RealDictCursor with the previous username as old_username, None if user does
+        not exist
+        """
+        cursor = self.get_cursor()
+        query = 'UPDATE chat_group SET version = version + 1 WHERE cid IN (' \
+                'SELECT cid FROM chat_group WHERE uid = %(uid)s ' \
+                'OR cid IN (SELECT cid FROM chat_members WHERE uid = %(uid)s) ' \
+                'OR cid IN (SELECT cid FROM messages WHERE uid = %(uid)s) ' \
+                'ORDER BY cid FOR UPDATE)'
+        cursor.execute(query, {'uid': uid})
+        query = 'WITH renamed AS (UPDATE users SET username = %s, ' \
+                'username_since = CURRENT_TIMESTAMP ' \
+                'FROM users AS old WHERE users.uid = %s AND old.uid = users.uid ' \
+                'RETURNING users.uid, users.username, users.first_name, users.last_name, ' \
+                'users.email, users.phone_number, old.username AS old_username) ' \
+                'SELECT uid, username, first_name, last_name, email, phone_number, ' \
+                'old_username ' \
+                "FROM renamed, pg_notify('usernames', renamed.old_username)"
+        cursor.execute(query, (new_username, uid))
+        user = cursor.fetchone()
+        if user is not None:
+            query = 'UPDATE messages SET updated_on = now(), version = CASE ' \
+                    'WHEN uid = %(uid)s THEN (SELECT version FROM chat_group ' \
+                    'WHERE chat_group.cid = messages.cid) ELSE version END ' \
+                    'WHERE uid = %(uid)s OR mid IN (SELECT mid FROM vote WHERE uid = %(uid)s)'
+            cursor.execute(query, {'uid': uid})
+        return user
+
     def get_user_by_phone_number(self, phone_number):
         """
         Gets user from database with matching phone number
@@ -100,78 +182,65 @@ class UserDAO(DAO):
         cursor.execute(query, (email,))
         return cursor.fetchall()[0]
 
-    def get_daily_messages_user(self, date, uid):
-        """
-        Gets number of messages posted on given date
-        :param date: datetime
-        :param uid: int
-        :return: RealDictCursor
-        """
-        cursor = self.get_cursor()
-        end_date = date + relativedelta(days=1)
-        query = 'SELECT count(*) AS num, username ' \
-                'FROM messages INNER JOIN users ON users.uid = messages.uid ' \
-                'WHERE messages.uid = %s AND messages.created_on > %s ' \
-                'AND messages.created_on < %s GROUP BY username'
-        cursor.execute(query, (uid, date, end_date,))
-        count = cursor.fetchone()
-        if count:
-            return count
-        else:
-            user = self.get_user(uid)[0]
-            return {'num': 0, 'username': user['username']}
-
-    def get_daily_active_users(self, date):
-        """
-        Gets daily active users from database
-        :param date: datetime
-        :return: RealDictCursor
-        """
-        cursor = self.get_cursor()
-        end_date = date + relativedelta(days=1)
-        query = 'WITH top_users AS (SELECT COUNT(*) AS amount, username ' \
-                'FROM messages INNER JOIN users ON messages.uid = users.uid ' \
-                'WHERE messages.created_on > %s AND messages.created_on < %s ' \
-                'GROUP BY username ORDER BY amount DESC)' \
-                'SELECT username FROM top_users LIMIT 10 '
-        cursor.execute(query, (date, end_date))
-        users = cursor.fetchall()
-        return users
-
     def insert_contact(self, owner_contact, contact_uid_to_add, first_name, last_name):
         """
-        Inserts a new contact to database
+        Inserts a new contact to database and increments the owner's contacts version
         :param owner_contact: int
         :param contact_uid_to_add: int
         :param first_name: str
         :param last_name: str
         """
         cursor = self.get_cursor()
-        query = 'INSERT INTO contacts (owner_id, contact_id, first_name, last_name) ' \
-                'VALUES (%s, %s, %s, %s)'
-        cursor.execute(query, (owner_contact, contact_uid_to_add, first_name, last_name,))
-        self.commit()
+        query = 'WITH added AS (INSERT INTO contacts (owner_id, contact_id, first_name, ' \
+                'last_name) VALUES (%s, %s, %s, %s)) ' \
+                'UPDATE users SET contacts_version = contacts_version + 1 WHERE uid = %s'
+        cursor.execute(query, (owner_contact, contact_uid_to_add, first_name, last_name,
+                               owner_contact))
 
     def delete_contact(self, owner_id, contact_id):
         """
-        Deletes contact from database
+        Deletes contact from database and increments the owner's contacts version
         :param owner_id: int
         :param contact_id: int
         """
         cursor = self.get_cursor()
-        query = 'DELETE FROM contacts WHERE owner_id = %s AND contact_id = %s'
+        query = 'WITH removed AS (DELETE FROM contacts ' \
+                'WHERE owner_id = %s AND contact_id = %s RETURNING owner_id) ' \
+                'UPDATE users SET contacts_version = contacts_version + 1 ' \
+                'WHERE uid IN (SELECT owner_id FROM removed)'
         cursor.execute(query, (owner_id, contact_id,))
-        self.commit()
 
-    def get_user_password(self, username):
+    def get_contacts_version(self, uid):
         """
-        Get's password for specified user from DB
-        :param username:
-        :return:
+        Gets version of user's contacts, which is incremented whenever one is added or deleted
+        :param uid: int
+        :return: int, None if user does not exist
         """
         cursor = self.get_cursor()
-        query = 'SELECT password ' \
+        query = 'SELECT contacts_version FROM users WHERE uid = %s'
+        cursor.execute(query, (uid,))
+        user = cursor.fetchone()
+        return user['contacts_version'] if user else None
+
+    def get_user_credentials(self, username):
+        """
+        Gets user and password hash for specified username in one query
+        :param username: str
+        :return: RealDictCursor, None if user does not exist
+        """
+        cursor = self.get_cursor()
+        query = 'SELECT uid, username, password, first_name, last_name, email, phone_number ' \
                 'FROM users ' \
                 'WHERE username = %s'
         cursor.execute(query, (username,))
-        return cursor.fetchone()['password'] if cursor.rowcount > 0 else None
+        return cursor.fetchone()
+
+    def update_password(self, uid, password):
+        """
+        Replaces password hash of user, e.g. when rehashing with a new work factor
+        :param uid: int
+        :param password: str bcrypt hash
+        """
+        cursor = self.get_cursor()
+        query = 'UPDATE users SET password = %s WHERE uid = %s'
+        cursor.execute(query, (password, uid))
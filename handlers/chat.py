@@ -1,34 +1,39 @@
-import uuid
-
-from cloudinary.uploader import upload
-from cloudinary.utils import cloudinary_url
 from flask import current_app as app
 from flask import jsonify, json
-from flask_jwt_extended import get_jwt_identity
-from werkzeug.utils import secure_filename
+from psycopg2.errors import ForeignKeyViolation
 
 from dao.chat_dao import ChatDAO
 from dao.message_dao import MessageDAO
 from dao.user_dao import UserDAO
+from handlers.identity import get_current_uid
+from handlers.membership import forget_chat, get_membership
+from handlers.pagination import decode_cursor, decode_since, encode_cursor, encode_since
+from utils.events import TooManyStreams, get_listener, stream_events
+from utils.uploads import discard_spooled_image, get_uploader, spool_image
+
+MESSAGES_PAGE_SIZE = 50
+MAX_MESSAGES_PAGE_SIZE = 100
+STREAMS_BUSY_RESPONSE = {'message': 'Too many open event streams, try again shortly'}
 
 
-def store_image(img):
+def parse_uids(*values):
     """
-    Stores image in cloudinary when running on production mode, otherwise,
-    image is stored in the static img diractory
-    :param img: File
-    :return: str
+    Parses user ids given as ints or comma separated strings into a list without duplicates
+    :param values: int/str
+    :return: list
+    :raises ValueError: if a value is not a user id
     """
-    if app.config['ENV'] == 'development':
-        img.filename = f'{uuid.uuid4()}{img.filename}'
-        filename = secure_filename(img.filename)
-        from app import ROOT_DIR
-        img.save(f'{ROOT_DIR}\\static\\img\\{filename}')
-        image_url = f'static/img/{filename}'
-    else:
-        upload_result = upload(img)
-        image_url = cloudinary_url(upload_result['public_id'], format='jpg')[0]
-    return image_url
+    uids = []
+    for value in values:
+        if value is None:
+            continue
+        for uid in str(value).split(','):
+            if not uid.strip():
+                continue
+            uid = int(uid)
+            if uid not in uids:
+                uids.append(uid)
+    return uids
 
 
 class ChatHandler:
@@ -36,16 +41,13 @@ class ChatHandler:
     def __init__(self):
         self.chat_dao = ChatDAO()
         self.message_dao = MessageDAO()
-        self.user_dao = UserDAO()
 
     def get_chats(self):
         """
         Gets all chats for current user
         :return: tuple
         """
-        username = get_jwt_identity()
-        user = self.user_dao.get_user_by_username(username)
-        chats = self.chat_dao.get_user_chats(user['uid'])
+        chats = self.chat_dao.get_user_chats(get_current_uid())
         response_data = json.dumps({'chats': chats})
         response_status = 200
         return response_data, response_status
@@ -59,13 +61,105 @@ class ChatHandler:
         chat = self.chat_dao.get_chat(cid)
         return chat
 
-    def get_chat_messages(self, cid):
+    def get_chat_events(self, cid):
         """
-        Gets messages pertaining to chat with given id
+        Gets stream of new messages, votes and photos of chat with given id
         :param cid: int
-        :return: RealDictCursor
+        :return: tuple of Server-Sent Events and status, or JSON and status if chat does not
+        exist or the worker streams too many events
+        """
+        if get_membership(cid) is None:
+            return json.dumps({'message': f'Chat {cid} does not exist'}), 404
+        heartbeat = app.config['EVENTS']['HEARTBEAT']
+        try:
+            return stream_events(get_listener(), cid, get_current_uid(), heartbeat), 200
+        except TooManyStreams:
+            return json.dumps(STREAMS_BUSY_RESPONSE), 503
+
+    def get_chat_version(self, cid):
+        """
+        Gets version of chat with given id, which changes whenever its messages change
+        :param cid: int
+        :return: int, None if chat does not exist
+        """
+        return self.chat_dao.get_chat_version(cid)
+
+    def get_chat_messages(self, cid, before=None, after=None, since=None, limit=None):
+        """
+        Gets a page of messages pertaining to chat with given id, newest first. next_cursor
+        is passed as before to get older messages and prev_cursor as after to get newer ones.
+        next_since is passed as since to get only messages created or changed afterwards,
+        in the order their changes committed, together with the next_since that follows them.
+        :param cid: int
+        :param before: str cursor
+        :param after: str cursor
+        :param since: str cursor
+        :param limit: int
+        :return: tuple
+        """
+        limit = MESSAGES_PAGE_SIZE if limit is None else limit
+        if limit < 1:
+            response_data = json.dumps({'message': 'limit must be at least 1', 'fields': ['limit']})
+            return response_data, 400
+        limit = min(limit, MAX_MESSAGES_PAGE_SIZE)
+        if since:
+            return self._get_chat_message_changes(cid, since, limit)
+        try:
+            before = decode_cursor(before) if before else None
+            after = decode_cursor(after) if after else None
+        except ValueError:
+            response_data = json.dumps({'message': 'Invalid cursor', 'fields': ['before', 'after']})
+            return response_data, 400
+
+        # Read before the page so changes committed meanwhile are synced again, not missed
+        version = self.chat_dao.get_chat_version(cid)
+        messages = self.chat_dao.get_chat_messages(cid, before=before, after=after, limit=limit)
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+        if after:
+            # Newer pages are read oldest first so the page starts right after the cursor
+            messages.reverse()
+        if messages:
+            newest, oldest = messages[0], messages[-1]
+            prev_cursor = encode_cursor(newest['created_on'], newest['mid'])
+            next_cursor = encode_cursor(oldest['created_on'], oldest['mid']) \
+                if has_more or after else None
+        else:
+            prev_cursor = next_cursor = None
+        response_data = json.dumps({
+            'messages': messages,
+            'next_cursor': next_cursor,
+            'prev_cursor': prev_cursor,
+            'next_since': encode_since(version) if version is not None else None
+        })
+        return response_data, 200
+
+    def _get_chat_message_changes(self, cid, since, limit):
         """
-        return self.chat_dao.get_chat_messages(cid)
+        Gets messages of chat created or changed after since, in the order their changes
+        committed
+        :param cid: int
+        :param since: str cursor
+        :param limit: int
+        :return: tuple
+        """
+        try:
+            parsed_since = decode_since(since)
+        except ValueError:
+            response_data = json.dumps({'message': 'Invalid cursor', 'fields': ['since']})
+            return response_data, 400
+        messages = self.chat_dao.get_chat_messages(cid, since=parsed_since, limit=limit)
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+        if messages:
+            last = messages[-1]
+            since = encode_since(last['version'], last['mid'])
+        response_data = json.dumps({
+            'messages': messages,
+            'has_more': has_more,
+            'next_since': since
+        })
+        return response_data, 200
 
     def get_chat_members(self, cid):
         """
@@ -91,14 +185,21 @@ class ChatHandler:
         """
         if 'chat_name' in data and data['chat_name']:
             chat_name = data['chat_name']
-            username = get_jwt_identity()
-            user = self.user_dao.get_user_by_username(username)
-            if data['members'] is not None:
-                members = data['members'].split(',')
-            else:
-                members = []
-            cid, created_on = self.chat_dao.insert_chat_group(chat_name, user['uid'],
-                                                              members=members)
+            try:
+                members = parse_uids(data['members'])
+            except ValueError:
+                response_data = json.dumps({'message': 'Members must be user ids',
+                                            'fields': ['members']})
+                return response_data, 400
+            try:
+                with self.chat_dao.transaction():
+                    cid, created_on = self.chat_dao.insert_chat_group(
+                        chat_name, get_current_uid(), members=members)
+            except ForeignKeyViolation:
+                response_data = json.dumps({'message': 'Members must be existing users',
+                                            'uids': UserDAO().get_unknown_uids(members),
+                                            'fields': ['members']})
+                return response_data, 400
             response_data = json.dumps({
                 'chat': {
                     'cid': cid,
@@ -113,75 +214,127 @@ class ChatHandler:
             response_status = 400
         return response_data, response_status
 
-    def insert_chat_message(self, cid, username, message, img=None):
+    def insert_chat_message(self, cid, message, img=None):
         """
-        Adds a new message to database
+        Adds a new message from current user to database
         :param cid: int
-        :param username: str
         :param message: str
         :param img: File
         :return: RealDictCursor
         """
-        if img:
-            img = store_image(img)
-        uid = UserDAO().get_user_by_username(username)['uid']
-        return self.message_dao.insert_message(cid, uid, message, img=img)
+        filename = self._spool_image(img) if img else None
+        mid = self.message_dao.insert_message(cid, get_current_uid(), message, img=filename)
+        if filename:
+            self._upload_after_commit(mid, filename)
+        return mid
+
+    def _spool_image(self, img):
+        """
+        Spools uploaded image, removing it again if the message is rolled back, since only
+        images of committed photos are resumed
+        :param img: File
+        :return: str spooled filename
+        """
+        filename = spool_image(img)
+        self.message_dao.uow.after_rollback(lambda: discard_spooled_image(filename))
+        return filename
+
+    def _upload_after_commit(self, mid, filename):
+        """
+        Queues upload of the spooled image of a message once the message is committed
+        :param mid: int
+        :param filename: str spooled filename
+        """
+        uploader = get_uploader()
+        self.message_dao.uow.after_commit(lambda: uploader.submit(mid, filename))
 
     def add_contact_to_chat_group(self, cid, data):
         """
-        Adds a contact from current user's contacts list to a chat group
+        Adds contacts from current user's contacts list to a chat group. Contacts are given
+        as a single contact_id and/or a list of contact_ids.
         :param cid: int
         :param data: dict
         :return: tuple
         """
-        current_user_username = get_jwt_identity()
-        current_user_uid = self.user_dao.get_user_by_username(current_user_username)['uid']
-        user_to_add = data['contact_id']
-        chat_owner_uid = self.chat_dao.get_owner_of_chat(cid)[0]['uid']
-
-        if chat_owner_uid != current_user_uid:
-            response_data = json.dumps({'msg': 'Not owner of chat'})
-            response_status = 403
-        else:
-            self.chat_dao.insert_member(cid, user_to_add)
-            response_data = json.dumps({'msg': 'Success'})
-            response_status = 201
-        return response_data, response_status
+        return self._update_chat_group_members(cid, data, self.chat_dao.insert_members)
 
     def remove_contact_from_chat_group(self, cid, data):
         """
-        Removes a contact from current user's contacts list from chat group
+        Removes contacts from current user's contacts list from chat group. Contacts are
+        given as a single contact_id and/or a list of contact_ids.
+        :param cid: int
+        :param data: dict
+        :return: tuple
+        """
+        return self._update_chat_group_members(cid, data, self.chat_dao.remove_members)
+
+    def _update_chat_group_members(self, cid, data, update):
+        """
+        Adds/Removes members of a chat group owned by current user in bulk
         :param cid: int
         :param data: dict
+        :param update: ChatDAO method taking the chat id and a list of uids
         :return: tuple
         """
-        current_user_username = get_jwt_identity()
-        current_user_uid = self.user_dao.get_user_by_username(current_user_username)['uid']
-        user_to_remove = data['contact_id']
-        chat_owner_uid = self.chat_dao.get_owner_of_chat(cid)[0]['uid']
+        current_user_uid = get_current_uid()
+        try:
+            uids = parse_uids(data.get('contact_id'), *(data.get('contact_ids') or []))
+        except ValueError:
+            response_data = json.dumps({'msg': 'Contacts must be user ids',
+                                        'fields': ['contact_id', 'contact_ids']})
+            return response_data, 400
+        if not uids:
+            response_data = json.dumps({'msg': 'No contacts given',
+                                        'fields': ['contact_id', 'contact_ids']})
+            return response_data, 400
+        membership = get_membership(cid)
 
-        if chat_owner_uid != current_user_uid:
+        if membership is None:
+            response_data = json.dumps({'msg': f'Chat {cid} does not exist'})
+            response_status = 404
+        elif not membership.is_owner(current_user_uid):
             response_data = json.dumps({'msg': 'Not owner of chat'})
             response_status = 403
         else:
-            self.chat_dao.remove_member(cid, user_to_remove)
-            response_data = json.dumps({'msg': 'Success'})
+            try:
+                with self.chat_dao.transaction():
+                    updated = update(cid, uids)
+            except ForeignKeyViolation:
+                response_data = json.dumps({'msg': 'Contacts must be existing users',
+                                            'uids': UserDAO().get_unknown_uids(uids),
+                                            'fields': ['contact_id', 'contact_ids']})
+                return response_data, 400
+            if updated:
+                self.chat_dao.uow.after_commit(lambda: forget_chat(cid))
+            response_data = json.dumps({'msg': 'Success', 'updated': updated})
             response_status = 201
         return response_data, response_status
 
     def reply_chat_message(self, data, mid):
         """
-        Adds a reply to an existing message
+        Adds a reply to an existing message of a chat the current user belongs to
         :param data: dict
         :param mid: int
         :return: tuple
         """
         message = data['message']
         cid = data['cid']
-        img = store_image(data['img']) if data['img'] else None
-        username = get_jwt_identity()
-        uid = self.user_dao.get_user_by_username(username)['uid']
-        rid = self.message_dao.insert_reply(message, uid, mid, cid, img=img)
+        replied_cid = self.message_dao.get_message_cid(mid)
+        if replied_cid is None:
+            return json.dumps({'message': f'Message {mid} does not exist'}), 404
+        if replied_cid != cid:
+            response_data = json.dumps({'message': 'Replies must be sent to the chat of the '
+                                                   'message they reply to', 'fields': ['cid']})
+            return response_data, 400
+        uid = get_current_uid()
+        membership = get_membership(cid)
+        if membership is None or not membership.is_member(uid):
+            response_data = json.dumps({'message': 'Not a member of chat', 'fields': ['cid']})
+            return response_data, 403
+        filename = self._spool_image(data['img']) if data['img'] else None
+        rid = self.message_dao.insert_reply(message, uid, mid, cid, img=filename)
+        if filename:
+            self._upload_after_commit(rid, filename)
         response_data = json.dumps({'rid': rid})
         response_status = 201
         return response_data, response_status
@@ -192,11 +345,12 @@ class ChatHandler:
         :param cid: int
         :return: JSON
         """
-        username = get_jwt_identity()
-        uid = self.user_dao.get_user_by_username(username)['uid']
-        chat_owner = self.chat_dao.get_owner_of_chat(cid)[0]['uid']
-        if uid == chat_owner:
+        membership = get_membership(cid)
+        if membership is None:
+            msg = 'Chat does not exist'
+        elif membership.is_owner(get_current_uid()):
             self.chat_dao.delete_chat(cid)
+            self.chat_dao.uow.after_commit(lambda: forget_chat(cid))
             msg = 'Deleted'
         else:
             msg = 'Not ur chat >:('
@@ -0,0 +1,82 @@
+import threading
+
+from flask import current_app
+from flask_jwt_extended import get_jwt, get_jwt_identity
+
+from dao.user_dao import UserDAO
+from utils.cache import TTLCache
+from utils.events import get_listener
+
+_UID_CACHE = None
+_UID_CACHE_LOCK = threading.Lock()
+
+
+def identity_claims(uid):
+    """
+    Gets claims embedded in JWTs issued to user so requests can skip looking up the uid
+    :param uid: int
+    :return: dict
+    """
+    return {'uid': uid}
+
+
+def get_current_uid():
+    """
+    Gets uid of the user making the request from the JWT claims, falling back to resolving
+    the JWT identity for tokens issued without them. Tokens issued by flask-jwt-extended 3
+    nest the claims under user_claims.
+    :return: int, None if user does not exist
+    """
+    token = get_jwt()
+    uid = token.get('uid', (token.get('user_claims') or {}).get('uid'))
+    if uid is not None:
+        return uid
+    return get_uid(get_jwt_identity(), token.get('iat', 0))
+
+
+def get_uid(username, issued_at):
+    """
+    Resolves username named by a token to uid through the username cache. Names taken over
+    after the token was issued, e.g. once its user renamed themselves, do not resolve.
+    :param username: str
+    :param issued_at: float seconds since the epoch the token was issued at
+    :return: int, None if no user held username when the token was issued
+    """
+    cache = _get_uid_cache()
+    holder = cache.get(username)
+    if holder is None:
+        user = UserDAO().get_username_holder(username)
+        if user is None:
+            return None
+        holder = (user['uid'], user['since'])
+        cache.set(username, holder)
+    uid, since = holder
+    return uid if since <= issued_at else None
+
+
+def forget_username(username):
+    """
+    Drops cached uid of username, e.g. when the username changes
+    :param username: str, None to drop every username
+    """
+    if _UID_CACHE is not None:
+        if username is None:
+            _UID_CACHE.clear()
+        else:
+            _UID_CACHE.delete(username)
+
+
+def _get_uid_cache():
+    """
+    Gets the username to uid cache of the current process, creating it on first use. Entries
+    are dropped when the chat event listener hears of usernames released by any worker.
+    :return: TTLCache
+    """
+    global _UID_CACHE
+    if _UID_CACHE is None:
+        with _UID_CACHE_LOCK:
+            if _UID_CACHE is None:
+                config = current_app.config['IDENTITY_CACHE']
+                get_listener().on_username_change(forget_username)
+                _UID_CACHE = TTLCache(config['MAX_SIZE'], ttl=config['TTL'])
+    return _UID_CACHE
@@ -0,0 +1,107 @@
+import functools
+import threading
+
+from flask import current_app, json
+
+from dao.chat_dao import ChatDAO
+from handlers.identity import get_current_uid
+from utils.cache import TTLCache
+from utils.events import get_listener
+
+_MEMBERSHIP_CACHE = None
+_MEMBERSHIP_CACHE_LOCK = threading.Lock()
+
+
+class ChatMembership:
+
+    def __init__(self, owner, members):
+        """
+        Owner and members of a chat, as cached for access checks
+        :param owner: int uid of the owner
+        :param members: iterable of uids of the other members
+        """
+        self.owner = owner
+        self.members = frozenset(members)
+
+    def is_owner(self, uid):
+        """
+        Checks whether user owns the chat
+        :param uid: int
+        :return: bool
+        """
+        return uid == self.owner
+
+    def is_member(self, uid):
+        """
+        Checks whether user owns or is a member of the chat
+        :param uid: int
+        :return: bool
+        """
+        return uid == self.owner or uid in self.members
+
+
+def get_membership(cid):
+    """
+    Gets owner and members of chat through the membership cache
+    :param cid: int
+    :return: ChatMembership, None if chat does not exist
+    """
+    cache = _get_membership_cache()
+    membership = cache.get(cid)
+    if membership is None:
+        chat = ChatDAO().get_chat_membership(cid)
+        if chat is None:
+            return None
+        membership = ChatMembership(chat['owner'], chat['members'])
+        cache.set(cid, membership)
+    return membership
+
+
+def forget_chat(cid):
+    """
+    Drops cached membership of chat, e.g. when its members change or it is deleted
+    :param cid: int, None to drop every chat
+    """
+    if _MEMBERSHIP_CACHE is not None:
+        if cid is None:
+            _MEMBERSHIP_CACHE.clear()
+        else:
+            _MEMBERSHIP_CACHE.delete(cid)
+
+
+def chat_access(method):
+    """
+    Lets a Resource method run only for the owner and members of the chat given by its cid or
+    chat_id keyword argument, answering 404 for missing chats and 403 for other users
+    :param method: Resource method
+    :return: wrapped method
+    """
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        cid = kwargs['cid'] if 'cid' in kwargs else kwargs['chat_id']
+        membership = get_membership(cid)
+        if membership is None:
+            response, status = {'message': f'Chat {cid} does not exist'}, 404
+        elif not membership.is_member(get_current_uid()):
+            response, status = {'message': 'Not a member of chat'}, 403
+        else:
+            return method(*args, **kwargs)
+        return current_app.response_class(response=json.dumps(response), status=status,
+                                          mimetype='application/json')
+    return wrapper
+
+
+def _get_membership_cache():
+    """
+    Gets the chat membership cache of the current process, creating it on first use. Entries
+    are dropped when the chat event listener hears of membership changes made by any worker.
+    :return: TTLCache
+    """
+    global _MEMBERSHIP_CACHE
+    if _MEMBERSHIP_CACHE is None:
+        with _MEMBERSHIP_CACHE_LOCK:
+            if _MEMBERSHIP_CACHE is None:
+                config = current_app.config['MEMBERSHIP_CACHE']
+                get_listener().on_membership_change(forget_chat)
+                _MEMBERSHIP_CACHE = TTLCache(config['MAX_SIZE'], ttl=config['TTL'])
+    return _MEMBERSHIP_CACHE
@@ -1,11 +1,19 @@
-import datetime
-
-from dateutil.relativedelta import relativedelta
-from flask import jsonify
-from flask_jwt_extended import get_jwt_identity
+from flask import current_app, json, jsonify
 
+from dao.chat_dao import ChatDAO
 from dao.message_dao import MessageDAO
-from dao.user_dao import UserDAO
+from handlers.identity import get_current_uid
+from handlers.membership import get_membership
+from handlers.pagination import decode_cursor, decode_rank_cursor, encode_cursor, \
+    encode_rank_cursor
+from utils.trending import get_tracker
+
+REPLIES_DEPTH = 3
+MAX_REPLIES_DEPTH = 10
+REPLIES_FANOUT = 20
+MAX_REPLIES_FANOUT = 100
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 100
 
 
 class MessageHandler:
@@ -28,13 +36,107 @@ class MessageHandler:
         """
         return self.dao.get_message(mid)
 
-    def get_replies(self, mid):
+    def get_messages_version(self):
+        """
+        Gets stamp that increases whenever any message changes
+        :return: int
+        """
+        return ChatDAO().get_chats_version()
+
+    def get_message_version(self, mid):
         """
-        Gets messages that have replied to given message id
+        Gets when message with specified id or its votes, replies or photo last changed
         :param mid: int
-        :return: RealDictCursor
+        :return: datetime, None if message does not exist
         """
-        return self.dao.get_message_replies(mid)
+        return self.dao.get_message_updated_on(mid)
+
+    def get_replies(self, mid, depth=None, fanout=None, after=None):
+        """
+        Gets the thread of replies under given message id as a tree, each reply holding its
+        own replies, for members of the message's chat. num_replies tells whether a reply has
+        more replies than were returned. next_cursor is passed as after to get the following
+        direct replies.
+        :param mid: int
+        :param depth: int levels of replies to get
+        :param fanout: int replies to get per message
+        :param after: str cursor
+        :return: tuple
+        """
+        cid = self.dao.get_message_cid(mid)
+        if cid is None:
+            return json.dumps({'message': f'Message {mid} does not exist'}), 404
+        membership = get_membership(cid)
+        if membership is None or not membership.is_member(get_current_uid()):
+            return json.dumps({'message': 'Not a member of chat'}), 403
+        depth = depth or REPLIES_DEPTH
+        fanout = fanout or REPLIES_FANOUT
+        if not 0 < depth <= MAX_REPLIES_DEPTH or not 0 < fanout <= MAX_REPLIES_FANOUT:
+            response_data = json.dumps({
+                'message': f'depth must be between 1 and {MAX_REPLIES_DEPTH} and fanout '
+                           f'between 1 and {MAX_REPLIES_FANOUT}',
+                'fields': ['depth', 'fanout']})
+            return response_data, 400
+        try:
+            after = decode_cursor(after) if after else None
+        except ValueError:
+            response_data = json.dumps({'message': 'Invalid cursor', 'fields': ['after']})
+            return response_data, 400
+
+        replies = []
+        messages = {}
+        next_cursor = None
+        for message in self.dao.get_message_replies(mid, depth=depth, fanout=fanout,
+                                                    after=after):
+            message['replies'] = []
+            if message['depth'] == 1:
+                if len(replies) == fanout:
+                    # Extra direct reply fetched only to tell that another page exists
+                    last = replies[-1]
+                    next_cursor = encode_cursor(last['created_on'], last['mid'])
+                    continue
+                replies.append(message)
+            else:
+                messages[message['replied_to']]['replies'].append(message)
+            messages[message['mid']] = message
+        response_data = json.dumps({'replies': replies, 'next_cursor': next_cursor})
+        return response_data, 200
+
+    def search_messages(self, text, cid=None, author=None, after=None, limit=None):
+        """
+        Searches messages of chats the current user belongs to, best matches first.
+        next_cursor is passed as after to get the following matches.
+        :param text: str
+        :param cid: int
+        :param author: int
+        :param after: str cursor
+        :param limit: int
+        :return: tuple
+        """
+        if not text or not text.strip():
+            response_data = json.dumps({'message': 'Search query cannot be blank', 'fields': ['q']})
+            return response_data, 400
+        limit = SEARCH_PAGE_SIZE if limit is None else limit
+        if limit < 1:
+            response_data = json.dumps({'message': 'limit must be at least 1', 'fields': ['limit']})
+            return response_data, 400
+        limit = min(limit, MAX_SEARCH_PAGE_SIZE)
+        try:
+            after = decode_rank_cursor(after) if after else None
+        except ValueError:
+            response_data = json.dumps({'message': 'Invalid cursor', 'fields': ['after']})
+            return response_data, 400
+
+        messages = self.dao.search_messages(get_current_uid(), text, cid=cid, author=author,
+                                            after=after, limit=limit)
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+        next_cursor = None
+        if has_more:
+            last = messages[-1]
+            next_cursor = encode_rank_cursor(last['rank'], last['mid'])
+        response_data = json.dumps({'messages': messages, 'next_cursor': next_cursor})
+        return response_data, 200
 
     def get_likers(self, mid):
         """
@@ -68,128 +170,52 @@ class MessageHandler:
         """
         return self._vote_message(mid, False)
 
-    def get_num_messages_daily(self):
-        """
-        Gets amount of messages posted per day
-        :return: JSOM
-        """
-        today = datetime.date.today()
-        num_posts = []
-        for i in range(7):
-            day_to_get = today - relativedelta(days=i)
-            num = self.dao.get_num_messages_daily(day_to_get)
-            num_posts.append({'day': day_to_get, 'total': num})
-        return jsonify(num_posts)
-
-    def get_num_likes_daily(self):
-        """
-        Gets daily amount of likes
-        :return: JSON
-        """
-        today = datetime.date.today()
-        num_likes = []
-        for i in range(7):
-            day_to_get = today - relativedelta(days=i)
-            num = self.dao.get_num_likes_daily(day_to_get, True)
-            num_likes.append({'day': day_to_get, 'total': num})
-        return jsonify(num_likes)
-
-    def get_num_dislikes_daily(self):
-        """
-        Gets daily number of dislikes
-        :return: JSON
-        """
-        today = datetime.date.today()
-        num_dislikes = []
-        for i in range(7):
-            day_to_get = today - relativedelta(days=i)
-            num = self.dao.get_num_likes_daily(day_to_get, False)
-            num_dislikes.append({'day': day_to_get, 'total': num})
-        return jsonify(num_dislikes)
-
-    def get_num_replies_daily(self):
-        """
-        Gets daily number of replies
-        :return: JSON
-        """
-        today = datetime.date.today()
-        num_replies = []
-        for i in range(7):
-            day_to_get = today - relativedelta(days=i)
-            num = self.dao.get_num_replies_daily(day_to_get)
-            num_replies.append({'day': day_to_get, 'total': num})
-        return jsonify(num_replies)
-
-    def get_num_replies_photo(self, pid):
-        """
-        Gets daily number of replies that contain images
-        :param pid: int
-        :return: JSON
-        """
-        today = datetime.date.today()
-        num_replies = []
-        for i in range(7):
-            day_to_get = today - relativedelta(days=i)
-            num = self.dao.get_num_replies_photos_daily(pid, day_to_get)
-            num_replies.append({'day': day_to_get, 'total': num})
-        return jsonify(num_replies)
-
-    def get_num_likes_photo(self, pid):
-        """
-        Gets daily number of likes for images
-        :param pid: int
-        :return: JSON
-        """
-        today = datetime.date.today()
-        num_likes = []
-        for i in range(7):
-            day_to_get = today - relativedelta(days=i)
-            num = self.dao.get_num_like_photos_daily(pid, day_to_get, True)
-            num_likes.append({'day': day_to_get, 'total': num})
-        return jsonify(num_likes)
-
-    def get_num_dislikes_photo(self, pid):
-        """
-        Gets number of dislikes for photo
-        :param pid: int
-        :return: JSON
-        """
-        today = datetime.date.today()
-        num_likes = []
-        for i in range(7):
-            day_to_get = today - relativedelta(days=i)
-            num = self.dao.get_num_like_photos_daily(pid, day_to_get, False)
-            num_likes.append({'day': day_to_get, 'total': num})
-        return jsonify(num_likes)
-
-    def get_trending_hashtags(self):
-        """
-        Gets trending hashtags
-        :return: JSON
+    def get_trending_hashtags(self, data):
+        """
+        Gets trending hashtags over requested window from the streaming tracker
+        :param data: dict with optional window and k
+        :return: tuple
         """
+        tracker = get_tracker()
+        window = data.get('window') or current_app.config['TRENDING']['DEFAULT_WINDOW']
+        if window not in tracker.windows:
+            return jsonify(message=f'window must be one of: {", ".join(tracker.windows)}',
+                           fields=['window']), 400
+        try:
+            k = int(data.get('k') or 10)
+        except ValueError:
+            k = 0
+        if not 0 < k <= tracker.capacity:
+            return jsonify(message=f'k must be between 1 and {tracker.capacity}',
+                           fields=['k']), 400
         trending_hashtags = []
-        hashtags = self.dao.get_trending_hashtags()
-        for i, hashtag in enumerate(hashtags):
-            trending_hashtags.append({'hashtag': hashtag['hashtag'], 'position': i + 1})
-        return jsonify(trending_hashtags)
+        for i, (hashtag, score) in enumerate(tracker.top(window, k)):
+            trending_hashtags.append({'hashtag': hashtag, 'position': i + 1,
+                                      'score': round(score, 3)})
+        return jsonify(trending_hashtags), 200
 
     def _vote_message(self, mid, upvote):
         """
-        Likes/Dislikes a message
+        Likes/Dislikes a message, toggling the vote off when it is cast again
         :param mid: int
         :param upvote: bool
-        :return: str
+        :return: dict
         """
-        user = get_jwt_identity()
-        uid = UserDAO().get_user_by_username(user)['uid']
-        try:
-            self.dao.vote_message(mid, uid, upvote)
+        vote = self.dao.vote_message(mid, get_current_uid(), upvote)
+        if vote is None:
+            return {'mid': mid, 'msg': 'Message does not exist'}
+
+        if vote['previous'] is None:
             msg = 'Successfully added vote'
-        except:
-            self.dao.conn.rollback()
-            deleted = self.dao.remove_vote(mid, uid, upvote)
-            if deleted:
-                msg = 'Successfully changed vote'
-            else:
-                msg = 'Successfully removed vote'
-        return msg
+        elif vote['upvote'] is None:
+            msg = 'Successfully removed vote'
+        else:
+            msg = 'Successfully changed vote'
+        state = {True: 'like', False: 'dislike', None: None}
+        return {
+            'mid': mid,
+            'msg': msg,
+            'vote': state[vote['upvote']],
+            'likes': vote['likes'],
+            'dislikes': vote['dislikes']
+        }
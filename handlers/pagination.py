@@ -0,0 +1,81 @@
+import base64
+import binascii
+import json
+
+from dateutil.parser import isoparse
+
+
+def encode_cursor(created_on, mid):
+    """
+    Encodes the (created_on, mid) keyset of a message into an opaque cursor
+    :param created_on: datetime
+    :param mid: int
+    :return: str
+    """
+    raw = json.dumps([created_on.isoformat(), mid])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    Decodes a cursor created by encode_cursor
+    :param cursor: str
+    :return: tuple (created_on, mid)
+    :raises ValueError: if cursor is malformed
+    """
+    try:
+        created_on, mid = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return isoparse(created_on), int(mid)
+    except (binascii.Error, TypeError, UnicodeError, AttributeError, OverflowError) as error:
+        raise ValueError(f'Invalid cursor: {cursor}') from error
+
+
+def encode_rank_cursor(rank, mid):
+    """
+    Encodes the (rank, mid) keyset of a search result into an opaque cursor
+    :param rank: float
+    :param mid: int
+    :return: str
+    """
+    raw = json.dumps([rank, mid])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_rank_cursor(cursor):
+    """
+    Decodes a cursor created by encode_rank_cursor
+    :param cursor: str
+    :return: tuple (rank, mid)
+    :raises ValueError: if cursor is malformed
+    """
+    try:
+        rank, mid = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return float(rank), int(mid)
+    except (binascii.Error, TypeError, UnicodeError, AttributeError, OverflowError) as error:
+        raise ValueError(f'Invalid cursor: {cursor}') from error
+
+
+def encode_since(version, mid=None):
+    """
+    Encodes the (chat version, mid) keyset of the last change a client has seen into an
+    opaque cursor
+    :param version: int chat version
+    :param mid: int, None if every change up to the version was seen
+    :return: str
+    """
+    raw = json.dumps([version, mid])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_since(cursor):
+    """
+    Decodes a cursor created by encode_since
+    :param cursor: str
+    :return: tuple (version, mid), mid None if every change up to the version was seen
+    :raises ValueError: if cursor is malformed
+    """
+    try:
+        version, mid = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return int(version), None if mid is None else int(mid)
+    except (binascii.Error, TypeError, UnicodeError, AttributeError, OverflowError) as error:
+        raise ValueError(f'Invalid cursor: {cursor}') from error
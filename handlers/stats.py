@@ -0,0 +1,90 @@
+import datetime
+
+from dateutil.parser import isoparse
+from flask import jsonify
+
+from dao.stats_dao import BUCKETS, StatsDAO
+from dao.user_dao import UserDAO
+
+DEFAULT_NUM_BUCKETS = 7
+MAX_NUM_BUCKETS = 1000
+BUCKET_SIZES = {
+    'hour': datetime.timedelta(hours=1),
+    'day': datetime.timedelta(days=1),
+    'week': datetime.timedelta(weeks=1)
+}
+
+
+def parse_range(data):
+    """
+    Parses from, to and bucket query parameters. Defaults to the last 7 buckets, ending today.
+    :param data: dict
+    :return: tuple (start, end, bucket)
+    :raises ValueError: if parameters are invalid
+    """
+    bucket = data.get('bucket') or 'day'
+    if bucket not in BUCKETS:
+        raise ValueError(f'bucket must be one of: {", ".join(BUCKETS)}')
+    end = isoparse(data['to']) if data.get('to') else datetime.datetime.now()
+    if data.get('from'):
+        start = isoparse(data['from'])
+    else:
+        start = end - BUCKET_SIZES[bucket] * (DEFAULT_NUM_BUCKETS - 1)
+    if (start.tzinfo is None) != (end.tzinfo is None):
+        raise ValueError('from and to must either both have a timezone or neither')
+    if start > end:
+        raise ValueError('from must not be after to')
+    if (end - start) / BUCKET_SIZES[bucket] > MAX_NUM_BUCKETS:
+        raise ValueError(f'Range cannot span more than {MAX_NUM_BUCKETS} buckets')
+    return start, end, bucket
+
+
+class StatsHandler:
+
+    def __init__(self):
+        self.dao = StatsDAO()
+
+    def get_metric(self, metric, data, key=None):
+        """
+        Gets number of events of given metric per bucket within requested range
+        :param metric: str
+        :param data: dict with optional from, to and bucket
+        :param key: int message id the metric is restricted to, if any
+        :return: tuple
+        """
+        try:
+            start, end, bucket = parse_range(data)
+        except ValueError as error:
+            return jsonify(message=str(error), fields=['from', 'to', 'bucket']), 400
+        series = self.dao.get_metric_series(metric, start, end, bucket, key=key)
+        return jsonify(series), 200
+
+    def get_user_messages(self, uid, data):
+        """
+        Gets number of messages posted by user per bucket within requested range
+        :param uid: int
+        :param data: dict with optional from, to and bucket
+        :return: tuple
+        """
+        try:
+            start, end, bucket = parse_range(data)
+        except ValueError as error:
+            return jsonify(message=str(error), fields=['from', 'to', 'bucket']), 400
+        user = UserDAO().get_user(uid)
+        if not user:
+            return jsonify(message=f'User with id: {uid} does not exist'), 404
+        series = self.dao.get_metric_series('user_messages', start, end, bucket, key=uid)
+        username = user[0]['username']
+        return jsonify([dict(row, username=username) for row in series]), 200
+
+    def get_active_users(self, data):
+        """
+        Gets users who posted the most messages per bucket within requested range
+        :param data: dict with optional from, to and bucket
+        :return: tuple
+        """
+        try:
+            start, end, bucket = parse_range(data)
+        except ValueError as error:
+            return jsonify(message=str(error), fields=['from', 'to', 'bucket']), 400
+        return jsonify(self.dao.get_active_users_series(start, end, bucket)), 200
@@ -1,12 +1,17 @@
 import datetime
 
-import bcrypt
-from dateutil.relativedelta import relativedelta
 from flask import jsonify, json
-from flask_jwt_extended import get_jwt_identity, create_access_token, create_refresh_token
+from flask_jwt_extended import create_access_token, create_refresh_token
 from psycopg2._psycopg import IntegrityError
 
 from dao.user_dao import UserDAO
+from handlers.identity import forget_username, get_current_uid, identity_claims
+from utils.hashing import HashingOverloaded, get_hasher
+
+BUSY_RESPONSE = {'message': 'Server is busy, try again shortly'}
+SEARCH_MIN_LENGTH = 3
+SEARCH_PAGE_SIZE = 10
+MAX_SEARCH_PAGE_SIZE = 50
 
 
 class UserHandler:
@@ -26,6 +31,29 @@ class UserHandler:
         """
         return self.dao.get_all_users()
 
+    def search_users(self, text, limit=None, contacts=False):
+        """
+        Searches users by username, names or email for type-ahead
+        :param text: str
+        :param limit: int
+        :param contacts: bool to only search contacts of the current user
+        :return: tuple
+        """
+        text = (text or '').strip()
+        if len(text) < SEARCH_MIN_LENGTH:
+            response_data = json.dumps({
+                'message': f'Search query must be at least {SEARCH_MIN_LENGTH} characters',
+                'fields': ['q']})
+            return response_data, 400
+        limit = SEARCH_PAGE_SIZE if limit is None else limit
+        if limit < 1:
+            response_data = json.dumps({'message': 'limit must be at least 1', 'fields': ['limit']})
+            return response_data, 400
+        limit = min(limit, MAX_SEARCH_PAGE_SIZE)
+        contacts_of = get_current_uid() if contacts else None
+        users = self.dao.search_users(text, limit=limit, contacts_of=contacts_of)
+        return json.dumps({'users': users}), 200
+
     def get_user_by_username(self, username):
         """
         Gets user by username
@@ -50,14 +78,21 @@ class UserHandler:
         """
         return self.dao.get_contacts(user_id)
 
+    def get_contacts_version(self, user_id):
+        """
+        Gets version of user contacts, which changes whenever a contact is added or removed
+        :param user_id: int
+        :return: int, None if user does not exist
+        """
+        return self.dao.get_contacts_version(user_id)
+
     def insert_contact(self, data):
         """
-        Adds new contact for user
+        Adds new contact for user, matched by id, phone number or email
         :param data: dict
         :return: RealDictCursor
         """
-        owner_username = get_jwt_identity()
-        owner_user = self.dao.get_user_by_username(owner_username)['uid']
+        owner_user = get_current_uid()
         try:
             first_name = data['first_name']
             last_name = data['last_name']
@@ -66,7 +101,12 @@ class UserHandler:
         except KeyError:
             return jsonify(msg='Missing parameters')
         try:
-            if phone_number:
+            if data.get('contact_id'):
+                # Users found through search are added by id
+                contact_to_add = data['contact_id']
+                if not self.dao.get_user(contact_to_add):
+                    return jsonify(msg='User does not exist')
+            elif phone_number:
                 contact_to_add = self.dao.get_user_by_phone_number(data['phone_number'])['uid']
             elif email:
                 contact_to_add = self.dao.get_user_by_email(data['email'])['uid']
@@ -99,20 +139,25 @@ class UserHandler:
         else:
             username = data['username']
             email = data['email']
-            password = bcrypt.hashpw(data['password'].encode('utf-8'),
-                                     bcrypt.gensalt()).decode('utf-8')
             first_name = data['first_name']
             last_name = data['last_name']
             phone_number = data['phone_number']
-
-            # Generates JWT access and refresh tokens for user.
-            access_token = create_access_token(identity=username,
-                                               expires_delta=datetime.timedelta(days=365))
-            refresh_token = create_refresh_token(identity=username)
+            try:
+                password = get_hasher().hash(data['password'])
+            except HashingOverloaded:
+                return json.dumps(BUSY_RESPONSE), 503
 
             try:
-                uid = self.dao.insert_user(username, password, first_name,
-                                           last_name, email, phone_number)
+                with self.dao.transaction():
+                    uid = self.dao.insert_user(username, password, first_name,
+                                               last_name, email, phone_number)
+
+                # Generates JWT access and refresh tokens for user.
+                access_token = create_access_token(identity=username,
+                                                   expires_delta=datetime.timedelta(days=365),
+                                                   additional_claims=identity_claims(uid))
+                refresh_token = create_refresh_token(identity=username,
+                                                     additional_claims=identity_claims(uid))
                 user = {
                     'user': {
                         'uid': uid,
@@ -139,14 +184,21 @@ class UserHandler:
         if data['username'] and data['password']:
             username = data['username']
             password = data['password']
-            db_password = self.dao.get_user_password(username)
-            user = self.dao.get_user_by_username(username)
-            is_authenticated = bcrypt.checkpw(password.encode('utf-8'),
-                                              db_password.encode('utf-8')) if db_password else False
+            user = self.dao.get_user_credentials(username)
+            hasher = get_hasher()
+            try:
+                is_authenticated = hasher.verify(password, user['password']) if user else False
+            except HashingOverloaded:
+                return json.dumps(BUSY_RESPONSE), 503
             if is_authenticated:
+                if hasher.needs_rehash(user['password']):
+                    self._rehash_password(user['uid'], password)
+                claims = identity_claims(user['uid'])
                 access_token = create_access_token(identity=user['username'],
-                                                   expires_delta=datetime.timedelta(days=365))
-                refresh_token = create_refresh_token(identity=user['username'])
+                                                   expires_delta=datetime.timedelta(days=365),
+                                                   additional_claims=claims)
+                refresh_token = create_refresh_token(identity=user['username'],
+                                                     additional_claims=claims)
                 user = {
                     'uid': user['uid'],
                     'username': user['username'],
@@ -181,15 +233,40 @@ class UserHandler:
             response_status = 400
         return response_data, response_status
 
-    def update_user_username(self, username, new_username):
+    def _rehash_password(self, uid, password):
         """
-        Updates username
-        :param username: str
+        Rehashes password of user with the configured work factor. Skipped while the hashing
+        pool is saturated since the next login retries it.
+        :param uid: int
+        :param password: str
+        """
+        try:
+            self.dao.update_password(uid, get_hasher().hash(password))
+        except HashingOverloaded:
+            pass
+
+    def update_user_username(self, new_username):
+        """
+        Renames the current user, issuing tokens naming the new username
         :param new_username: str
-        :return: RealDictCursor
+        :return: dict, None if user does not exist or new_username is taken
         """
-        user = self.get_user_by_username(username)
-        user['username'] = new_username
+        uid = get_current_uid()
+        try:
+            with self.dao.transaction():
+                user = self.dao.update_username(uid, new_username)
+        except IntegrityError:
+            return None
+        if user is None:
+            return None
+        for changed in (user.pop('old_username'), new_username):
+            self.dao.uow.after_commit(lambda changed=changed: forget_username(changed))
+        claims = identity_claims(uid)
+        user['access_token'] = create_access_token(identity=new_username,
+                                                   expires_delta=datetime.timedelta(days=365),
+                                                   additional_claims=claims)
+        user['refresh_token'] = create_refresh_token(identity=new_username,
+                                                     additional_claims=claims)
         return user
 
     def remove_contact(self, data):
@@ -199,39 +276,7 @@ class UserHandler:
         :return: JSON
         """
         contact_id = data['contact_id']
-        username = get_jwt_identity()
-        uid = self.dao.get_user_by_username(username)['uid']
+        uid = get_current_uid()
         self.dao.delete_contact(uid, contact_id)
         new_contacts = self.dao.get_contacts(uid)
         return jsonify(contacts=new_contacts)
-
-    def get_daily_active_users(self):
-        """
-        Gets daily active users
-        :return: JSON
-        """
-        today = datetime.datetime.today()
-        users = []
-        for i in range(7):
-            day_to_get = today - relativedelta(days=i)
-            num = self.dao.get_daily_active_users(day_to_get)
-            users.append({'day': '%s' % day_to_get, 'users': num})
-        return jsonify(users)
-
-    def get_num_messages_user(self, uid):
-        """
-        Gets daily number of messages posted by user
-        :param uid: int
-        :return: JSON
-        """
-        today = datetime.datetime.today()
-        num_messages = []
-        for i in range(7):
-            day_to_get = today - relativedelta(days=i)
-            num = self.dao.get_daily_messages_user(day_to_get, uid)
-            num_messages.append({
-                'username': num['username'],
-                'day': day_to_get,
-                'total': num['num']
-            })
-        return jsonify(num_messages)
@@ -1,10 +1,13 @@
 from flask import jsonify, request, current_app as app
 from flask_jwt_extended import create_access_token, get_jwt_identity, jwt_required
-from flask_restful import Resource, reqparse
+from flask_restful import Resource, inputs, reqparse
 
 from handlers.chat import ChatHandler
+from handlers.identity import get_current_uid, identity_claims
+from handlers.membership import chat_access
 from handlers.message import MessageHandler
 from handlers.users import UserHandler
+from utils.conditional import conditional
 
 HELP_TEXT = 'This field cannot be blank'
 
@@ -64,23 +67,41 @@ class Users(Resource):
     def __init__(self):
         self.handler = UserHandler()
 
-    # @jwt_required
+    # @jwt_required()
     def get(self):
         users = self.handler.get_users()
         return jsonify(users=users)
 
-    # @jwt_required
+    @jwt_required()
     def put(self):
         parser = reqparse.RequestParser()
         parser.add_argument('new_username')
         data = parser.parse_args()
         if 'new_username' in data and data['new_username']:
-            user = self.handler.update_user_username(username='ninja', new_username='Cherdleys')
+            user = self.handler.update_user_username(new_username=data['new_username'])
             return jsonify(user=user)
         else:
             return jsonify(msg='Bad request')
 
 
+class UserSearch(Resource):
+
+    @jwt_required()
+    def get(self):
+        """
+        Searches users, or only the user's contacts, by username, names or email
+        :return: JSON
+        """
+        parser = reqparse.RequestParser()
+        parser.add_argument('q', help=HELP_TEXT, required=True, location='args')
+        parser.add_argument('limit', type=int, location='args')
+        parser.add_argument('contacts', type=inputs.boolean, default=False, location='args')
+        data = parser.parse_args()
+        response, status = UserHandler().search_users(data['q'], limit=data['limit'],
+                                                      contacts=data['contacts'])
+        return app.response_class(response=response, status=status, mimetype='application/json')
+
+
 class User(Resource):
     def __init__(self):
         self.handler = UserHandler()
@@ -98,12 +119,12 @@ class Chats(Resource):
     def __init__(self):
         self.handler = ChatHandler()
 
-    @jwt_required
+    @jwt_required()
     def get(self):
         response, status = self.handler.get_chats()
         return app.response_class(response=response, status=status, mimetype='application/json')
 
-    @jwt_required
+    @jwt_required()
     def post(self):
         parser = reqparse.RequestParser()
         parser.add_argument('chat_name', help=HELP_TEXT, required=True)
@@ -118,17 +139,18 @@ class Contacts(Resource):
     def __init__(self):
         self.handler = UserHandler()
 
-    @jwt_required
+    @jwt_required()
     def post(self):
         parser = reqparse.RequestParser()
         parser.add_argument('first_name', help=HELP_TEXT, required=True)
         parser.add_argument('last_name', help=HELP_TEXT, required=True)
         parser.add_argument('email', help=HELP_TEXT)
         parser.add_argument('phone_number', help=HELP_TEXT)
+        parser.add_argument('contact_id', type=int)
         data = parser.parse_args()
         return self.handler.insert_contact(data)
 
-    # @jwt_required
+    # @jwt_required()
     def put(self):
         parser = reqparse.RequestParser()
         parser.add_argument('contact_id', help=HELP_TEXT, required=True)
@@ -136,7 +158,7 @@ class Contacts(Resource):
         contact = self.handler.update_contact(1)
         return jsonify(contact=contact)
 
-    @jwt_required
+    @jwt_required()
     def delete(self):
         parser = reqparse.RequestParser()
         parser.add_argument('contact_id', help=HELP_TEXT, required=True)
@@ -149,6 +171,7 @@ class Contact(Resource):
     def __init__(self):
         self.handler = UserHandler()
 
+    @conditional(lambda uid: UserHandler().get_contacts_version(uid))
     def get(self, uid):
         contacts = self.handler.get_contacts(uid)
         return jsonify(contacts=contacts)
@@ -160,42 +183,49 @@ class Chat(Resource):
         self.parser = reqparse.RequestParser()
         self.parser.add_argument('contact_id', help=HELP_TEXT, required=True)
 
+    @jwt_required()
+    @chat_access
+    @conditional(lambda cid: ChatHandler().get_chat_version(cid))
     def get(self, cid):
         chat = ChatHandler().get_chat(cid)
         return jsonify(chat=chat)
 
-    @jwt_required
+    @jwt_required()
     def post(self, cid):
         data = self.parser.parse_args()
         chat = ChatHandler().add_contact_to_chat_group(cid, data)
         return jsonify(chat=chat)
 
-    @jwt_required
+    @jwt_required()
     def delete(self, cid):
         return ChatHandler().delete_chat(cid)
 
 
 class ChatMembers(Resource):
 
-    @jwt_required
+    @jwt_required()
+    @chat_access
+    @conditional(lambda cid: ChatHandler().get_chat_version(cid))
     def get(self, cid):
         chat_members = ChatHandler().get_chat_members(cid)
         return jsonify(chat_members=chat_members)
 
-    @jwt_required
+    @jwt_required()
     def post(self, cid):
         parser = reqparse.RequestParser()
-        parser.add_argument('contact_id', help=HELP_TEXT, required=True)
+        parser.add_argument('contact_id')
+        parser.add_argument('contact_ids', action='append')
 
         data = parser.parse_args()
 
         response, status = ChatHandler().add_contact_to_chat_group(cid, data)
         return app.response_class(response=response, status=status, mimetype='application/json')
 
-    @jwt_required
+    @jwt_required()
     def delete(self, cid):
         parser = reqparse.RequestParser()
-        parser.add_argument('contact_id', help=HELP_TEXT, required=True)
+        parser.add_argument('contact_id')
+        parser.add_argument('contact_ids', action='append')
 
         data = parser.parse_args()
 
@@ -203,31 +233,62 @@ class ChatMembers(Resource):
         return app.response_class(response=response, status=status, mimetype='application/json')
 
 
+class ChatEvents(Resource):
+
+    @jwt_required()
+    @chat_access
+    def get(self, chat_id):
+        """
+        Streams new messages, votes and photos of given chat id as Server-Sent Events
+        :param chat_id: int
+        :return: event stream
+        """
+        response, status = ChatHandler().get_chat_events(chat_id)
+        if status != 200:
+            return app.response_class(response=response, status=status,
+                                      mimetype='application/json')
+        return app.response_class(response=response, status=status,
+                                  mimetype='text/event-stream',
+                                  headers={'Cache-Control': 'no-cache',
+                                           'X-Accel-Buffering': 'no'})
+
+
 class ChatMessages(Resource):
 
-    @jwt_required
+    @jwt_required()
+    @chat_access
+    @conditional(lambda chat_id: ChatHandler().get_chat_version(chat_id))
     def get(self, chat_id):
         """
-        Gets all messages from given chat id.
+        Gets a page of messages from given chat id, or only those changed since a message or
+        time. Responses are tagged with the chat version so unchanged chats get a 304.
         :param chat_id: id of the chat messages are to be extracted from
         :return: JSON representation of messages table
         """
-        messages = ChatHandler().get_chat_messages(chat_id)
-        return jsonify(messages=messages)
+        parser = reqparse.RequestParser()
+        parser.add_argument('before', location='args')
+        parser.add_argument('after', location='args')
+        parser.add_argument('since', location='args')
+        parser.add_argument('limit', type=int, location='args')
+        data = parser.parse_args()
+        response, status = ChatHandler().get_chat_messages(chat_id, before=data['before'],
+                                                           after=data['after'],
+                                                           since=data['since'],
+                                                           limit=data['limit'])
+        return app.response_class(response=response, status=status, mimetype='application/json')
 
-    @jwt_required
+    @jwt_required()
+    @chat_access
     def post(self, chat_id):
         parser = reqparse.RequestParser()
         parser.add_argument('uid', help=HELP_TEXT, required=True)
         parser.add_argument('message', help=HELP_TEXT, required=True)
         data = parser.parse_args()
         if 'img' in request.files and request.files['img']:
-            message = ChatHandler().insert_chat_message(cid=chat_id, username=get_jwt_identity(),
-                                                        message=data['message'],
+            message = ChatHandler().insert_chat_message(cid=chat_id, message=data['message'],
                                                         img=request.files['img'])
         else:
-            message = ChatHandler().insert_chat_message(cid=chat_id, username=get_jwt_identity(),
-                                                        message=data['message'])
+            message = ChatHandler().insert_chat_message(cid=chat_id, message=data['message'])
         return jsonify(message=message)
 
 
@@ -236,16 +297,41 @@ class Messages(Resource):
     def __init__(self):
         self.handler = MessageHandler()
 
+    @conditional(lambda: MessageHandler().get_messages_version())
     def get(self):
         messages = self.handler.get_all_messages()
         return jsonify(messages=messages)
 
 
+class SearchMessages(Resource):
+
+    @jwt_required()
+    def get(self):
+        """
+        Searches messages of chats the user belongs to, optionally only those of a chat or
+        author, best matches first
+        :return: JSON
+        """
+        parser = reqparse.RequestParser()
+        parser.add_argument('q', help=HELP_TEXT, required=True, location='args')
+        parser.add_argument('cid', type=int, location='args')
+        parser.add_argument('uid', type=int, location='args')
+        parser.add_argument('after', location='args')
+        parser.add_argument('limit', type=int, location='args')
+        data = parser.parse_args()
+        response, status = MessageHandler().search_messages(data['q'], cid=data['cid'],
+                                                            author=data['uid'],
+                                                            after=data['after'],
+                                                            limit=data['limit'])
+        return app.response_class(response=response, status=status, mimetype='application/json')
+
+
 class Message(Resource):
 
     def __init__(self):
         self.handler = MessageHandler()
 
+    @conditional(lambda mid: MessageHandler().get_message_version(mid))
     def get(self, mid):
         message = self.handler.get_message(mid)
         return jsonify(message=message)
@@ -256,11 +342,12 @@ class LikeChatMessage(Resource):
     def __init__(self):
         self.handler = MessageHandler()
 
+    @conditional(lambda mid: MessageHandler().get_message_version(mid))
     def get(self, mid):
         likers = self.handler.get_likers(mid)
         return jsonify(likers=likers, likes=len(likers))
 
-    @jwt_required
+    @jwt_required()
     def post(self, mid):
         message = self.handler.like_message(mid)
         return jsonify(message=message)
@@ -271,11 +358,12 @@ class DislikeChatMessage(Resource):
     def __init__(self):
         self.handler = MessageHandler()
 
+    @conditional(lambda mid: MessageHandler().get_message_version(mid))
     def get(self, mid):
         dislikers = MessageHandler().get_dislikers(mid)
         return jsonify(dislikers=dislikers, dislikes=len(dislikers))
 
-    @jwt_required
+    @jwt_required()
     def post(self, mid):
         message = self.handler.dislike_message(mid)
         return jsonify(message=message)
@@ -286,15 +374,27 @@ class ReplyChatMessage(Resource):
     def __init__(self):
         self.handler = MessageHandler()
 
+    @jwt_required()
     def get(self, mid):
-        replies = self.handler.get_replies(mid)
-        return jsonify(replies=replies)
+        """
+        Gets the thread of replies under given message id
+        :param mid: int
+        :return: JSON
+        """
+        parser = reqparse.RequestParser()
+        parser.add_argument('depth', type=int, location='args')
+        parser.add_argument('fanout', type=int, location='args')
+        parser.add_argument('after', location='args')
+        data = parser.parse_args()
+        response, status = self.handler.get_replies(mid, depth=data['depth'],
+                                                    fanout=data['fanout'], after=data['after'])
+        return app.response_class(response=response, status=status, mimetype='application/json')
 
-    @jwt_required
+    @jwt_required()
     def post(self, mid):
         parser = reqparse.RequestParser()
         parser.add_argument('message', help=HELP_TEXT, required=True)
-        parser.add_argument('cid', help=HELP_TEXT, required=True)
+        parser.add_argument('cid', type=int, help=HELP_TEXT, required=True)
         data = parser.parse_args()
         data['img'] = None
         if 'img' in request.files and request.files['img']:
@@ -305,8 +405,11 @@ class ReplyChatMessage(Resource):
 
 class TokenRefresh(Resource):
 
-    # @jwt_refresh_token_required
+    @jwt_required(refresh=True)
     def post(self):
-        current_user = get_jwt_identity()
-        access_token = create_access_token(identity=current_user)
+        uid = get_current_uid()
+        if uid is None:
+            return jsonify(msg='User does not exist'), 401
+        access_token = create_access_token(identity=get_jwt_identity(),
+                                           additional_claims=identity_claims(uid))
         return jsonify(access_token=access_token)
@@ -0,0 +1,143 @@
+import functools
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, make_response, request
+
+_STATS_CACHE = None
+_STATS_CACHE_LOCK = threading.Lock()
+
+
+class TTLCache:
+
+    def __init__(self, maxsize, ttl=None):
+        """
+        Thread safe LRU cache whose entries optionally expire
+        :param maxsize: int entries kept before the least recently used one is evicted
+        :param ttl: float default seconds entries live, None for no expiry
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Gets value cached under key
+        :param key: hashable
+        :param default: object returned on a miss
+        :return: object
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[1] is None or entry[1] > time.monotonic()):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        """
+        Caches value under key
+        :param key: hashable
+        :param value: object
+        :param ttl: float seconds value lives, defaults to the cache ttl
+        """
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """
+        Removes key from cache
+        :param key: hashable
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def delete_matching(self, predicate):
+        """
+        Removes every key predicate holds for
+        :param predicate: callable taking a key
+        """
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                del self._entries[key]
+
+    def clear(self):
+        """
+        Removes every entry
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Gets cache size and hit/miss counters
+        :return: dict
+        """
+        with self._lock:
+            return {'size': len(self._entries), 'max_size': self.maxsize,
+                    'hits': self.hits, 'misses': self.misses}
+
+
+def get_stats_cache():
+    """
+    Gets the cache of stats responses of the current process, creating it on first use
+    :return: TTLCache
+    """
+    global _STATS_CACHE
+    if _STATS_CACHE is None:
+        with _STATS_CACHE_LOCK:
+            if _STATS_CACHE is None:
+                _STATS_CACHE = TTLCache(current_app.config['STATS_CACHE']['MAX_SIZE'])
+    return _STATS_CACHE
+
+
+def invalidate_stats(*tags):
+    """
+    Drops cached stats responses depending on any of the given tags
+    :param tags: str
+    """
+    if _STATS_CACHE is not None:
+        tags = set(tags)
+        _STATS_CACHE.delete_matching(lambda key: not tags.isdisjoint(key[0]))
+
+
+def cached_response(ttl, tags=()):
+    """
+    Caches successful responses of a view per path and query parameters
+    :param ttl: float seconds responses are cached
+    :param tags: tuple of str naming the data responses depend on, for invalidate_stats
+    :return: decorator
+    """
+    tags = frozenset(tags)
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            cache = get_stats_cache()
+            key = (tags, request.path, tuple(sorted(request.args.items(multi=True))))
+            cached = cache.get(key)
+            if cached is not None:
+                data, mimetype = cached
+                response = current_app.response_class(data, status=200, mimetype=mimetype)
+                response.headers['X-Cache'] = 'HIT'
+                return response
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200:
+                cache.set(key, (response.get_data(), response.mimetype), ttl=ttl)
+            response.headers['X-Cache'] = 'MISS'
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,52 @@
+import gzip
+
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, responses are then only gzipped
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = {'application/json', 'text/html', 'text/plain', 'text/csv',
+                          'text/css', 'application/javascript'}
+
+
+def _encodings():
+    """
+    Gets content codings this server can produce, most preferred first
+    :return: list of str
+    """
+    return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+
+def compress_response(response):
+    """
+    Compresses response bodies above the configured size with the best coding the client
+    accepts. Streams, files and already encoded responses are left untouched.
+    :param response: Response
+    :return: Response
+    """
+    config = current_app.config['COMPRESSION']
+    if response.direct_passthrough or response.is_streamed \
+            or response.status_code < 200 or response.status_code in (204, 206, 304) \
+            or 'Content-Encoding' in response.headers \
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if len(data) < config['MIN_SIZE']:
+        return response
+    encoding = request.accept_encodings.best_match(_encodings())
+    if encoding == 'br':
+        data = brotli.compress(data, quality=config['BROTLI_QUALITY'])
+    elif encoding == 'gzip':
+        data = gzip.compress(data, compresslevel=config['GZIP_LEVEL'])
+    else:
+        return response
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        # The encoded body is no longer byte for byte the tagged representation
+        response.set_etag(etag, weak=True)
+    return response
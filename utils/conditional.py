@@ -0,0 +1,65 @@
+import datetime
+import functools
+import hashlib
+
+from flask import current_app, make_response, request
+
+
+def make_etag(stamp):
+    """
+    Makes a strong ETag from the version stamp of the requested resource
+    :param stamp: version stamp
+    :return: str
+    """
+    if isinstance(stamp, datetime.datetime):
+        stamp = stamp.timestamp()
+    raw = repr((request.full_path, stamp)).encode('utf-8')
+    return hashlib.sha1(raw).hexdigest()[:24]
+
+
+def is_not_modified(etag, last_modified):
+    """
+    Checks the request's If-None-Match/If-Modified-Since headers against the resource. As in
+    RFC 7232, If-Modified-Since is only considered without If-None-Match.
+    :param etag: str
+    :param last_modified: datetime, None if unknown
+    :return: bool
+    """
+    if request.if_none_match:
+        # Weak comparison so ETags weakened by response compression still match
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and last_modified is not None:
+        return last_modified.replace(microsecond=0) <= request.if_modified_since
+    return False
+
+
+def conditional(version):
+    """
+    Answers conditional GETs of a Resource method with a 304 before the method runs when the
+    resource has not changed, and tags full responses with an ETag (and Last-Modified for
+    timestamp stamps) so clients can revalidate
+    :param version: callable taking the keyword arguments of the method and returning a cheap
+    version stamp of the resource (a counter, tuple or last modified datetime), None to skip
+    :return: decorator
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            stamp = version(**kwargs)
+            if stamp is None:
+                return method(*args, **kwargs)
+            etag = make_etag(stamp)
+            last_modified = stamp if isinstance(stamp, datetime.datetime) else None
+            if is_not_modified(etag, last_modified):
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(method(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,330 @@
+import json
+import os
+import queue
+import select
+import threading
+import time
+
+import psycopg2
+from flask import current_app
+
+from dao.pool import connection_params
+
+_LISTENER = None
+_LISTENER_PID = None
+_LISTENER_LOCK = threading.Lock()
+
+CHANNEL_PREFIX = 'chat_'
+
+# Channel membership changes of every chat are sent on, always listened to
+MEMBERS_CHANNEL = 'chat_members'
+
+# Channel usernames released by renames are sent on, always listened to
+USERNAMES_CHANNEL = 'usernames'
+
+# Seconds between checks for channels to (un)listen while no notification arrives
+POLL_INTERVAL = 5
+
+# Seconds before reconnecting after the listening connection broke
+RECONNECT_DELAY = 1
+
+
+class TooManyStreams(Exception):
+    """
+    Raised when the worker already streams as many events as it may
+    """
+
+
+def chat_channel(cid):
+    """
+    Gets the NOTIFY channel events of a chat are sent on
+    :param cid: int
+    :return: str
+    """
+    return f'{CHANNEL_PREFIX}{int(cid)}'
+
+
+class Subscription:
+
+    def __init__(self, cid, uid, queue_size):
+        """
+        Events of a chat waiting to be streamed to one client
+        :param cid: int
+        :param uid: int user the events are streamed to
+        :param queue_size: int events buffered before the client is considered too slow
+        """
+        self.cid = cid
+        self.uid = uid
+        self.events = queue.Queue(maxsize=queue_size)
+        self.overflowed = False
+        self.revoked = False
+
+    def revoke_if_removed(self, change):
+        """
+        Marks the subscription revoked if a membership change removed its user from the chat
+        :param change: dict membership change, removed None when the removed users are unknown
+        """
+        if change['type'] == 'deleted' or change.get('removed') is None \
+                or self.uid in change['removed']:
+            self.revoked = True
+
+    def push(self, event):
+        """
+        Buffers event, marking the subscription overflowed if the client fell too far behind
+        :param event: tuple of event type and JSON payload
+        """
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+
+class ChatEventListener:
+
+    def __init__(self, database, queue_size, max_streams):
+        """
+        Listens on the NOTIFY channels of every chat with subscribers over one dedicated
+        connection and fans notifications out to the subscriptions of the chat. Membership
+        changes of all chats are always listened to and passed to membership callbacks, and
+        released usernames to username callbacks.
+        :param database: dict database config
+        :param queue_size: int events buffered per subscription
+        :param max_streams: int subscriptions open at once, each holding a request thread
+        """
+        self.database = database
+        self.queue_size = queue_size
+        self.max_streams = max_streams
+        self._streams = 0
+        self._membership_callbacks = []
+        self._username_callbacks = []
+        self._subscriptions = {}
+        self._listening = set()
+        self._conn = None
+        self._lock = threading.Lock()
+        self._wake_read, self._wake_write = os.pipe()
+        os.set_blocking(self._wake_write, False)
+
+    def on_membership_change(self, callback):
+        """
+        Registers callback run with the id of a chat whose members changed or which was
+        deleted, and with None after reconnecting, when changes may have been missed
+        :param callback: callable taking a cid
+        """
+        self._membership_callbacks.append(callback)
+
+    def on_username_change(self, callback):
+        """
+        Registers callback run with a username released by a rename, and with None after
+        reconnecting, when renames may have been missed
+        :param callback: callable taking a username
+        """
+        self._username_callbacks.append(callback)
+
+    def subscribe(self, cid, uid):
+        """
+        Subscribes user to events of a chat
+        :param cid: int
+        :param uid: int
+        :return: Subscription
+        :raises TooManyStreams: if the worker already has max_streams subscriptions
+        """
+        subscription = Subscription(cid, uid, self.queue_size)
+        with self._lock:
+            if self._streams >= self.max_streams:
+                raise TooManyStreams()
+            self._streams += 1
+            self._subscriptions.setdefault(cid, set()).add(subscription)
+        self._wake()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """
+        Stops delivering events to subscription, doing nothing if it already stopped
+        :param subscription: Subscription
+        """
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.cid)
+            if subscriptions is not None and subscription in subscriptions:
+                self._streams -= 1
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.cid]
+        self._wake()
+
+    def run(self, logger):
+        """
+        Listens for notifications forever, reconnecting when the connection breaks
+        :param logger: Logger
+        """
+        while True:
+            try:
+                self._conn = psycopg2.connect(**connection_params(self.database))
+                self._conn.autocommit = True
+                self._listening = set()
+                with self._conn.cursor() as cursor:
+                    cursor.execute(f'LISTEN {MEMBERS_CHANNEL}')
+                    cursor.execute(f'LISTEN {USERNAMES_CHANNEL}')
+                self._membership_changed(None)
+                self._username_released(None)
+                self._listen()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('Chat event listener lost its connection')
+            finally:
+                if self._conn is not None:
+                    self._conn.close()
+                    self._conn = None
+            time.sleep(RECONNECT_DELAY)
+
+    def _listen(self):
+        """
+        Waits for notifications or subscription changes and handles them
+        """
+        while True:
+            self._sync_channels()
+            readable, _, _ = select.select([self._conn, self._wake_read], [], [], POLL_INTERVAL)
+            if self._wake_read in readable:
+                os.read(self._wake_read, 4096)
+            if self._conn in readable:
+                self._conn.poll()
+                while self._conn.notifies:
+                    self._dispatch(self._conn.notifies.pop(0))
+
+    def _sync_channels(self):
+        """
+        Listens on channels of newly subscribed chats and stops listening on channels of
+        chats without subscribers
+        """
+        with self._lock:
+            wanted = set(self._subscriptions)
+        if wanted == self._listening:
+            return
+        with self._conn.cursor() as cursor:
+            for cid in wanted - self._listening:
+                cursor.execute(f'LISTEN {chat_channel(cid)}')
+            for cid in self._listening - wanted:
+                cursor.execute(f'UNLISTEN {chat_channel(cid)}')
+        self._listening = wanted
+
+    def _dispatch(self, notify):
+        """
+        Delivers notification to the subscriptions of its chat. Membership changes revoke
+        subscriptions of removed users. Released usernames go to username callbacks.
+        :param notify: Notify
+        """
+        if notify.channel == USERNAMES_CHANNEL:
+            self._username_released(notify.payload)
+            return
+        data = json.loads(notify.payload)
+        if notify.channel == MEMBERS_CHANNEL:
+            cid = data['cid']
+            self._membership_changed(cid)
+        else:
+            cid = int(notify.channel[len(CHANNEL_PREFIX):])
+        event = (data['type'], notify.payload)
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(cid, ()))
+        for subscription in subscriptions:
+            if notify.channel == MEMBERS_CHANNEL:
+                subscription.revoke_if_removed(data)
+            subscription.push(event)
+
+    def _membership_changed(self, cid):
+        """
+        Runs membership callbacks
+        :param cid: int, None if any chat may have changed
+        """
+        for callback in self._membership_callbacks:
+            callback(cid)
+
+    def _username_released(self, username):
+        """
+        Runs username callbacks
+        :param username: str, None if any username may have been released
+        """
+        for callback in self._username_callbacks:
+            callback(username)
+
+    def _wake(self):
+        """
+        Interrupts the listener's wait so subscription changes are applied right away
+        """
+        try:
+            os.write(self._wake_write, b'\0')
+        except BlockingIOError:
+            pass
+
+
+class EventStream:
+
+    def __init__(self, listener, subscription, heartbeat):
+        """
+        Server-Sent Events of a subscription, unsubscribing once the response is closed even
+        if it was never iterated
+        :param listener: ChatEventListener
+        :param subscription: Subscription
+        :param heartbeat: float seconds between keep-alive comments
+        """
+        self.listener = listener
+        self.subscription = subscription
+        self.heartbeat = heartbeat
+
+    def __iter__(self):
+        """
+        Yields events, sending comments while idle so proxies keep the connection open
+        :return: generator of str
+        """
+        subscription = self.subscription
+        try:
+            yield f'retry: {RECONNECT_DELAY * 1000}\n\n'
+            while not subscription.overflowed and not subscription.revoked:
+                try:
+                    event_type, payload = subscription.events.get(timeout=self.heartbeat)
+                except queue.Empty:
+                    yield ': keep-alive\n\n'
+                    continue
+                yield f'event: {event_type}\ndata: {payload}\n\n'
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Unsubscribes, called by the WSGI server once the response is done
+        """
+        self.listener.unsubscribe(self.subscription)
+
+
+def stream_events(listener, cid, uid, heartbeat):
+    """
+    Streams events of a chat to a user as Server-Sent Events. The stream ends if the client
+    falls too far behind, and the client then reconnects and refetches what it missed. It
+    also ends once the user is removed from the chat or the chat is deleted, so reconnecting
+    checks access again.
+    :param listener: ChatEventListener
+    :param cid: int
+    :param uid: int
+    :param heartbeat: float seconds between keep-alive comments
+    :return: EventStream
+    :raises TooManyStreams: if the worker already streams as many events as it may
+    """
+    return EventStream(listener, listener.subscribe(cid, uid), heartbeat)
+
+
+def get_listener():
+    """
+    Gets the chat event listener of the current process, creating it and its thread on
+    first use
+    :return: ChatEventListener
+    """
+    global _LISTENER, _LISTENER_PID
+    pid = os.getpid()
+    if _LISTENER is None or _LISTENER_PID != pid:
+        with _LISTENER_LOCK:
+            if _LISTENER is None or _LISTENER_PID != pid:
+                config = current_app.config['EVENTS']
+                listener = ChatEventListener(current_app.config['DATABASE'],
+                                             config['QUEUE_SIZE'], config['MAX_STREAMS'])
+                thread = threading.Thread(target=listener.run, daemon=True,
+                                          args=(current_app.logger,))
+                thread.start()
+                _LISTENER, _LISTENER_PID = listener, pid
+    return _LISTENER
@@ -0,0 +1,126 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+
+import bcrypt
+from flask import current_app
+
+_HASHER = None
+_HASHER_PID = None
+_HASHER_LOCK = threading.Lock()
+
+# Hashing processes start from a clean server process rather than forking the app's
+# threads, locks and database connections
+_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+
+class HashingOverloaded(Exception):
+    """
+    Raised when too many passwords are already waiting to be hashed or checked
+    """
+
+
+def _hash_password(password, rounds):
+    """
+    Hashes password with bcrypt
+    :param password: str
+    :param rounds: int bcrypt work factor
+    :return: str
+    """
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def _check_password(password, hashed):
+    """
+    Checks password against bcrypt hash
+    :param password: str
+    :param hashed: str
+    :return: bool
+    """
+    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+
+
+class PasswordHasher:
+
+    def __init__(self, rounds, workers, max_pending, timeout):
+        """
+        Runs bcrypt in a bounded process pool so hashing does not pin request threads
+        :param rounds: int bcrypt work factor of new hashes
+        :param workers: int processes hashing passwords
+        :param max_pending: int hashes running or queued before new ones are rejected
+        :param timeout: float seconds to wait for a hash
+        """
+        self.rounds = rounds
+        self.timeout = timeout
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context(_START_METHOD))
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def hash(self, password):
+        """
+        Hashes password with the configured work factor
+        :param password: str
+        :return: str
+        :raises HashingOverloaded: if the pool is saturated
+        """
+        return self._run(_hash_password, password, self.rounds)
+
+    def verify(self, password, hashed):
+        """
+        Checks password against hash
+        :param password: str
+        :param hashed: str
+        :return: bool
+        :raises HashingOverloaded: if the pool is saturated
+        """
+        return self._run(_check_password, password, hashed)
+
+    def needs_rehash(self, hashed):
+        """
+        Checks whether hash was made with a different work factor than the configured one
+        :param hashed: str
+        :return: bool
+        """
+        try:
+            return int(hashed.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+    def _run(self, function, *args):
+        """
+        Runs function in the process pool unless too many calls are pending
+        :param function: callable
+        :param args: arguments of function
+        :return: result of function
+        :raises HashingOverloaded: if the pool is saturated or the call times out
+        """
+        if not self._slots.acquire(blocking=False):
+            raise HashingOverloaded('Too many pending password hashes')
+        try:
+            future = self._executor.submit(function, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError as error:
+            raise HashingOverloaded('Timed out waiting for password hash') from error
+
+
+def get_hasher():
+    """
+    Gets the password hasher of the current process, creating it on first use
+    :return: PasswordHasher
+    """
+    global _HASHER, _HASHER_PID
+    pid = os.getpid()
+    if _HASHER is None or _HASHER_PID != pid:
+        with _HASHER_LOCK:
+            if _HASHER is None or _HASHER_PID != pid:
+                config = current_app.config['BCRYPT']
+                _HASHER = PasswordHasher(config['ROUNDS'], config['WORKERS'],
+                                         config['MAX_PENDING'], config['TIMEOUT'])
+                _HASHER_PID = pid
+    return _HASHER
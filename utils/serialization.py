@@ -0,0 +1,100 @@
+import decimal
+
+from flask import current_app, make_response
+from flask.json.provider import DefaultJSONProvider, JSONProvider
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, Flask's encoder is used without it
+    orjson = None
+
+
+def _default(obj):
+    """
+    Serializes types orjson does not handle natively
+    :param obj: object
+    :return: JSON serializable object
+    :raises TypeError: if obj is not serializable
+    """
+    if isinstance(obj, decimal.Decimal):
+        return str(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    if hasattr(obj, '__html__'):
+        return str(obj.__html__())
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+class OrjsonProvider(JSONProvider):
+    """
+    JSON provider backed by orjson, which serializes query rows (dict subclasses), datetimes
+    and UUIDs natively. Datetimes are written in ISO 8601.
+    """
+
+    def dumps(self, obj, **kwargs):
+        """
+        Serializes obj to a JSON string
+        :param obj: object
+        :param kwargs: ignored, accepted for compatibility with json.dumps
+        :return: str
+        """
+        return self.dumps_bytes(obj).decode('utf-8')
+
+    def dumps_bytes(self, obj):
+        """
+        Serializes obj to JSON bytes without decoding them
+        :param obj: object
+        :return: bytes
+        """
+        option = orjson.OPT_NON_STR_KEYS
+        if self._app.debug:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=_default, option=option)
+
+    def loads(self, s, **kwargs):
+        """
+        Deserializes JSON
+        :param s: str or bytes
+        :param kwargs: ignored, accepted for compatibility with json.loads
+        :return: object
+        """
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        """
+        Makes a JSON response, as jsonify does
+        :return: Response
+        """
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self.dumps_bytes(obj), mimetype='application/json')
+
+
+PROVIDERS = {'orjson': OrjsonProvider, 'default': DefaultJSONProvider}
+
+
+def init_json(app):
+    """
+    Installs the JSON provider named in the JSON_PROVIDER config, used by jsonify,
+    flask.json.dumps and Flask-RESTful responses. Falls back to Flask's provider when orjson
+    is not installed.
+    :param app: Flask
+    """
+    name = app.config['JSON_PROVIDER']
+    if name not in PROVIDERS:
+        raise ValueError(f'Unknown JSON provider: {name}')
+    if name == 'orjson' and orjson is None:
+        name = 'default'
+    app.json = PROVIDERS[name](app)
+
+
+def output_json(data, code, headers=None):
+    """
+    Flask-RESTful representation serializing resource return values with the app's provider
+    :param data: object
+    :param code: int
+    :param headers: dict
+    :return: Response
+    """
+    response = make_response(current_app.json.response(data), code)
+    response.headers.extend(headers or {})
+    return response
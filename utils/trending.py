@@ -0,0 +1,221 @@
+import math
+import os
+import socket
+import threading
+import time
+
+from flask import current_app
+
+from dao.trending_dao import TrendingDAO
+
+_TRACKER = None
+_TRACKER_PID = None
+_TRACKER_LOCK = threading.Lock()
+
+# Snapshots older than this many window lifetimes hold negligible weight and are deleted
+STALE_LIFETIMES = 5
+
+# Forward decay weights grow as exp(age / lifetime), rescale before they overflow floats
+MAX_EXPONENT = 500
+
+
+class DecayedSpaceSaving:
+
+    def __init__(self, capacity, lifetime, now=None):
+        """
+        Space-Saving heavy hitters summary whose counts decay exponentially with time, so a
+        use of an item weighs exp(-age / lifetime). Decay is applied forward from a landmark
+        time so adding stays O(1) apart from evictions.
+        :param capacity: int number of counters kept
+        :param lifetime: float seconds
+        :param now: float epoch seconds
+        """
+        self.capacity = capacity
+        self.lifetime = lifetime
+        self._landmark = time.time() if now is None else now
+        self._counters = {}
+
+    def add(self, item, now, count=1.0):
+        """
+        Adds count uses of item at given time, evicting the smallest counter when full
+        :param item: str
+        :param now: float epoch seconds
+        :param count: float
+        """
+        if (now - self._landmark) / self.lifetime > MAX_EXPONENT:
+            self._rescale(now)
+        weight = count * math.exp((now - self._landmark) / self.lifetime)
+        if item in self._counters:
+            self._counters[item] += weight
+        elif len(self._counters) < self.capacity:
+            self._counters[item] = weight
+        else:
+            smallest = min(self._counters, key=self._counters.get)
+            self._counters[item] = self._counters.pop(smallest) + weight
+
+    def merge(self, counts, now):
+        """
+        Adds counts decayed to given time, e.g. a snapshot of another summary
+        :param counts: dict mapping item to count
+        :param now: float epoch seconds
+        """
+        for item, count in counts.items():
+            self.add(item, now, count)
+
+    def counts(self, now):
+        """
+        Gets counts decayed to given time
+        :param now: float epoch seconds
+        :return: dict
+        """
+        scale = math.exp(-(now - self._landmark) / self.lifetime)
+        return {item: weight * scale for item, weight in self._counters.items()}
+
+    def _rescale(self, now):
+        """
+        Moves landmark to given time
+        :param now: float epoch seconds
+        """
+        self._counters = self.counts(now)
+        self._landmark = now
+
+
+class TrendingTracker:
+
+    def __init__(self, windows, capacity):
+        """
+        Tracks trending hashtags of this worker over every window and merges in the
+        snapshots of other workers
+        :param windows: dict mapping window name to lifetime in seconds
+        :param capacity: int hashtags tracked per window
+        """
+        self.worker = f'{socket.gethostname()}:{os.getpid()}'
+        self.windows = windows
+        self.capacity = capacity
+        self._local = {name: DecayedSpaceSaving(capacity, lifetime)
+                       for name, lifetime in windows.items()}
+        self._peers = {name: DecayedSpaceSaving(capacity, lifetime)
+                       for name, lifetime in windows.items()}
+        self._lock = threading.Lock()
+
+    def record(self, hashtags, now=None, count=1):
+        """
+        Records use of hashtags
+        :param hashtags: list of str
+        :param now: float epoch seconds
+        :param count: int times each hashtag was used
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            for summary in self._local.values():
+                for hashtag in hashtags:
+                    summary.add(hashtag, now, count)
+
+    def top(self, window, k, now=None):
+        """
+        Gets the k hashtags with the highest decayed counts over given window
+        :param window: str
+        :param k: int
+        :param now: float epoch seconds
+        :return: list of (hashtag, score) tuples
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            counts = self._peers[window].counts(now)
+            for hashtag, count in self._local[window].counts(now).items():
+                counts[hashtag] = counts.get(hashtag, 0) + count
+        return sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:k]
+
+    def snapshot(self, now=None):
+        """
+        Gets this worker's counts of every window decayed to given time
+        :param now: float epoch seconds
+        :return: dict mapping window name to counts
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            return {name: summary.counts(now) for name, summary in self._local.items()}
+
+    def sync(self, dao, now=None):
+        """
+        Saves this worker's counts and replaces peer counts with the merged snapshots of
+        every other worker
+        :param dao: TrendingDAO
+        :param now: float epoch seconds
+        """
+        now = time.time() if now is None else now
+        for window, counts in self.snapshot(now).items():
+            dao.save_snapshot(self.worker, window, counts, now)
+        dao.delete_snapshots(now - STALE_LIFETIMES * max(self.windows.values()))
+
+        peers = {name: DecayedSpaceSaving(self.capacity, lifetime, now=now)
+                 for name, lifetime in self.windows.items()}
+        for row in dao.get_snapshots(self.worker):
+            summary = peers.get(row['window_name'])
+            if summary is not None:
+                age = now - float(row['taken_at'])
+                decay = math.exp(-age / summary.lifetime)
+                summary.merge({hashtag: count * decay
+                               for hashtag, count in row['counts'].items()}, now)
+        with self._lock:
+            self._peers = peers
+
+
+def seed_from_history(dao, windows, capacity, now=None):
+    """
+    Saves a snapshot of the hashtags used in messages still inside every window, so trending
+    hashtags are available before workers have recorded any
+    :param dao: TrendingDAO
+    :param windows: dict mapping window name to lifetime in seconds
+    :param capacity: int hashtags tracked per window
+    :param now: float epoch seconds
+    :return: int number of (hashtag, hour) groups seeded
+    """
+    now = time.time() if now is None else now
+    tracker = TrendingTracker(windows, capacity)
+    tracker.worker = 'history'
+    history = dao.get_hashtag_history(now - STALE_LIFETIMES * max(windows.values()))
+    for row in history:
+        tracker.record([row['hashtag']], now=float(row['used_at']), count=row['num'])
+    for window, counts in tracker.snapshot(now).items():
+        dao.save_snapshot(tracker.worker, window, counts, now)
+    return len(history)
+
+
+def _sync_forever(app, tracker, interval):
+    """
+    Periodically syncs tracker with the snapshots of other workers
+    :param app: Flask
+    :param tracker: TrendingTracker
+    :param interval: float seconds
+    """
+    while True:
+        with app.app_context():
+            try:
+                dao = TrendingDAO()
+                tracker.sync(dao)
+                dao.commit()
+            except Exception:  # pylint: disable=broad-except
+                app.logger.exception('Could not sync trending hashtags')
+        time.sleep(interval)
+
+
+def get_tracker():
+    """
+    Gets the trending tracker of the current process, creating it and its sync thread on
+    first use
+    :return: TrendingTracker
+    """
+    global _TRACKER, _TRACKER_PID
+    pid = os.getpid()
+    if _TRACKER is None or _TRACKER_PID != pid:
+        with _TRACKER_LOCK:
+            if _TRACKER is None or _TRACKER_PID != pid:
+                config = current_app.config['TRENDING']
+                tracker = TrendingTracker(config['WINDOWS'], config['CAPACITY'])
+                thread = threading.Thread(target=_sync_forever, daemon=True,
+                                          args=(current_app._get_current_object(), tracker,
+                                                config['SYNC_INTERVAL']))
+                thread.start()
+                _TRACKER, _TRACKER_PID = tracker, pid
+    return _TRACKER
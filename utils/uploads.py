@@ -0,0 +1,303 @@
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from cloudinary.uploader import upload
+from cloudinary.utils import cloudinary_url
+from flask import abort, current_app, send_file
+from werkzeug.utils import secure_filename
+
+from dao.message_dao import MessageDAO
+from utils.variants import make_variants
+
+_UPLOADER = None
+_UPLOADER_PID = None
+_UPLOADER_LOCK = threading.Lock()
+
+COPY_CHUNK_SIZE = 64 * 1024
+IMAGE_NAME = re.compile(r'[0-9a-f]{64}(\.[a-z0-9]{1,10})?')
+
+# Image formats served, by extension. Anything else is sent as an opaque download.
+IMAGE_MIMETYPES = {'.jpg': 'image/jpeg', '.png': 'image/png', '.gif': 'image/gif',
+                   '.webp': 'image/webp'}
+
+# Stored images never change content, so clients may cache them for a year
+IMAGE_MAX_AGE = 365 * 24 * 60 * 60
+
+
+class LocalImageStore:
+
+    def __init__(self, directory, url_prefix='images'):
+        """
+        Stores images in a local directory addressed by the SHA-256 of their content, so
+        identical images are stored once and their urls never change content
+        :param directory: str
+        :param url_prefix: str path images are served under
+        """
+        self.directory = directory
+        self.url_prefix = url_prefix
+
+    def store(self, path, filename):
+        """
+        Copies spooled image into the store, hashing it while it is written. The extension
+        of the stored image is given by its content, never by the client's filename.
+        :param path: str path of spooled image
+        :param filename: str
+        :return: str url of stored image
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        digest = hashlib.sha256()
+        header = b''
+        with tempfile.NamedTemporaryFile(dir=self.directory, delete=False) as stored:
+            try:
+                with open(path, 'rb') as spooled:
+                    for chunk in iter(lambda: spooled.read(COPY_CHUNK_SIZE), b''):
+                        header = header or chunk
+                        digest.update(chunk)
+                        stored.write(chunk)
+            except BaseException:
+                os.remove(stored.name)
+                raise
+        name = digest.hexdigest() + image_extension(header)
+        target = self._path(name)
+        if os.path.exists(target):
+            os.remove(stored.name)
+        else:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(stored.name, target)
+        return f'{self.url_prefix}/{name}'
+
+    def path_of(self, name):
+        """
+        Gets path of stored image
+        :param name: str image name as given in its url
+        :return: str, None if no such image is stored
+        """
+        if not IMAGE_NAME.fullmatch(name):
+            return None
+        path = self._path(name)
+        return path if os.path.isfile(path) else None
+
+    def _path(self, name):
+        """
+        Gets path of image in the store, sharded by the first bytes of its hash so no
+        directory grows too large
+        :param name: str
+        :return: str
+        """
+        return os.path.join(self.directory, name[:2], name[2:4], name)
+
+
+class CloudinaryImageStore:
+
+    def store(self, path, filename):
+        """
+        Uploads spooled image to cloudinary
+        :param path: str path of spooled image
+        :param filename: str
+        :return: str url of stored image
+        """
+        upload_result = upload(path)
+        return cloudinary_url(upload_result['public_id'], format='jpg')[0]
+
+    def path_of(self, name):
+        """
+        Images are served by cloudinary
+        :param name: str
+        :return: None
+        """
+        return None
+
+
+def image_extension(header):
+    """
+    Gets the extension of an image from the signature of its format
+    :param header: bytes leading bytes of the image
+    :return: str extension, empty if the content is not an image format that is served
+    """
+    if header.startswith(b'\xff\xd8\xff'):
+        return '.jpg'
+    if header.startswith(b'\x89PNG\r\n\x1a\n'):
+        return '.png'
+    if header.startswith((b'GIF87a', b'GIF89a')):
+        return '.gif'
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return '.webp'
+    return ''
+
+
+def make_image_store(config, root_dir):
+    """
+    Creates the image store backend named in config
+    :param config: dict IMAGE_STORE config
+    :param root_dir: str app root directory
+    :return: image store
+    :raises ValueError: if backend is unknown
+    """
+    backend = config['BACKEND']
+    if backend == 'local':
+        return LocalImageStore(config['DIRECTORY'] or os.path.join(root_dir, 'images'))
+    if backend == 'cloudinary':
+        return CloudinaryImageStore()
+    raise ValueError(f'Unknown image store backend: {backend}')
+
+
+def spool_image(img):
+    """
+    Saves uploaded image to the spool directory until it is pushed to the image store
+    :param img: File
+    :return: str spooled filename
+    """
+    spool_dir = current_app.config['IMAGE_STORE']['SPOOL_DIR']
+    os.makedirs(spool_dir, exist_ok=True)
+    filename = f'{uuid.uuid4().hex}{secure_filename(img.filename)}'
+    img.save(os.path.join(spool_dir, filename))
+    return filename
+
+
+def discard_spooled_image(filename):
+    """
+    Removes image from the spool directory, e.g. when the message it belongs to rolled back
+    :param filename: str spooled filename
+    """
+    try:
+        os.remove(os.path.join(current_app.config['IMAGE_STORE']['SPOOL_DIR'], filename))
+    except FileNotFoundError:
+        pass
+
+
+class ImageUploader:
+
+    def __init__(self, app, store, spool_dir, workers, max_attempts, retry_delay,
+                 variant_sizes=None, variant_quality=80):
+        """
+        Pushes spooled images and their resized variants to the image store in background
+        threads and marks their photos ready, retrying failed uploads with exponential backoff
+        :param app: Flask
+        :param store: image store
+        :param spool_dir: str
+        :param workers: int uploads running at once
+        :param max_attempts: int attempts before a photo is marked failed
+        :param retry_delay: float seconds before the first retry
+        :param variant_sizes: dict mapping variant name to its maximum width and height
+        :param variant_quality: int JPEG quality of variants
+        """
+        self.app = app
+        self.store = store
+        self.spool_dir = spool_dir
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.variant_sizes = variant_sizes or {}
+        self.variant_quality = variant_quality
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='image-upload')
+
+    def submit(self, mid, filename):
+        """
+        Queues upload of the spooled image of a message
+        :param mid: int
+        :param filename: str spooled filename
+        :return: Future
+        """
+        return self._executor.submit(self._upload, mid, filename)
+
+    def shutdown(self):
+        """
+        Waits for queued uploads to finish
+        """
+        self._executor.shutdown(wait=True)
+
+    def _upload(self, mid, filename):
+        """
+        Uploads spooled image and its resized variants and records the outcome on the
+        message photo
+        :param mid: int
+        :param filename: str spooled filename
+        """
+        path = os.path.join(self.spool_dir, filename)
+        image_url = self._store(mid, path, filename)
+        variant_urls = {}
+        if image_url is not None:
+            try:
+                variant_paths = make_variants(path, self.variant_sizes, self.variant_quality)
+            except Exception:  # pylint: disable=broad-except
+                self.app.logger.warning('Could not resize image of message %s', mid,
+                                        exc_info=True)
+                variant_paths = {}
+            for variant, variant_path in variant_paths.items():
+                variant_url = self._store(mid, variant_path, os.path.basename(variant_path))
+                if variant_url is not None:
+                    variant_urls[variant] = variant_url
+                os.remove(variant_path)
+        with self.app.app_context():
+            try:
+                dao = MessageDAO()
+                dao.update_photo(mid, image_url, variant_urls)
+                dao.commit()
+            except Exception:  # pylint: disable=broad-except
+                self.app.logger.exception('Could not update photo of message %s', mid)
+                return
+        if image_url is not None and os.path.exists(path):
+            os.remove(path)
+
+    def _store(self, mid, path, filename):
+        """
+        Pushes file to the image store, retrying with exponential backoff
+        :param mid: int message the image belongs to
+        :param path: str
+        :param filename: str
+        :return: str url of stored image, None if every attempt failed
+        """
+        for attempt in range(self.max_attempts):
+            try:
+                return self.store.store(path, filename)
+            except Exception:  # pylint: disable=broad-except
+                self.app.logger.warning('Could not upload image of message %s', mid,
+                                        exc_info=True)
+                if attempt + 1 < self.max_attempts:
+                    time.sleep(self.retry_delay * 2 ** attempt)
+        return None
+
+
+def send_image(name):
+    """
+    Sends stored image with a strong ETag of its hash, Range support and immutable caching.
+    Only image formats are sent with their type, and browsers are told not to sniff it.
+    The file itself is sent by the web server when USE_X_SENDFILE is set.
+    :param name: str image name as given in its url
+    :return: Response
+    """
+    path = get_uploader().store.path_of(name)
+    if path is None:
+        abort(404)
+    mimetype = IMAGE_MIMETYPES.get(os.path.splitext(name)[1], 'application/octet-stream')
+    response = send_file(path, mimetype=mimetype, conditional=True,
+                         etag=name.split('.')[0], max_age=IMAGE_MAX_AGE)
+    response.headers['Cache-Control'] = f'public, max-age={IMAGE_MAX_AGE}, immutable'
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    return response
+
+
+def get_uploader():
+    """
+    Gets the image uploader of the current process, creating it on first use
+    :return: ImageUploader
+    """
+    global _UPLOADER, _UPLOADER_PID
+    pid = os.getpid()
+    if _UPLOADER is None or _UPLOADER_PID != pid:
+        with _UPLOADER_LOCK:
+            if _UPLOADER is None or _UPLOADER_PID != pid:
+                config = current_app.config['IMAGE_STORE']
+                app = current_app._get_current_object()
+                _UPLOADER = ImageUploader(app, make_image_store(config, app.root_path),
+                                          config['SPOOL_DIR'], config['WORKERS'],
+                                          config['MAX_ATTEMPTS'], config['RETRY_DELAY'],
+                                          config['VARIANTS'], config['VARIANT_QUALITY'])
+                _UPLOADER_PID = pid
+    return _UPLOADER
@@ -0,0 +1,31 @@
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional, photos are then served without variants
+    Image = None
+
+
+def make_variants(path, sizes, quality):
+    """
+    Writes downscaled JPEG copies of an image next to it, one per variant that is smaller
+    than the original
+    :param path: str
+    :param sizes: dict mapping variant name to the maximum width and height in pixels
+    :param quality: int JPEG quality of variants
+    :return: dict mapping variant name to the path of its file, empty without Pillow
+    """
+    if Image is None or not sizes:
+        return {}
+    variants = {}
+    with Image.open(path) as original:
+        original = ImageOps.exif_transpose(original)
+        for name, size in sorted(sizes.items(), key=lambda item: -item[1]):
+            if max(original.size) <= size:
+                continue
+            variant = original.copy()
+            variant.thumbnail((size, size), Image.LANCZOS)
+            if variant.mode not in ('RGB', 'L'):
+                variant = variant.convert('RGB')
+            variant_path = f'{path}.{name}.jpg'
+            variant.save(variant_path, 'JPEG', quality=quality, optimize=True, progressive=True)
+            variants[name] = variant_path
+    return variants